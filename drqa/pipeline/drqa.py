@@ -7,7 +7,6 @@
 """Full DrQA pipeline."""
 
 import torch
-import regex
 import heapq
 import math
 import time
@@ -19,6 +18,7 @@ from multiprocessing.util import Finalize
 from ..reader.vector import batchify
 from ..reader.data import ReaderDataset, SortedBatchSampler
 from .. import reader
+from .. import retriever
 from .. import tokenizers
 from . import DEFAULTS
 
@@ -30,24 +30,16 @@ logger = logging.getLogger(__name__)
 # ------------------------------------------------------------------------------
 
 PROCESS_TOK = None
-PROCESS_DB = None
 PROCESS_CANDS = None
 
 
-def init(tokenizer_class, tokenizer_opts, db_class, db_opts, candidates=None):
-    global PROCESS_TOK, PROCESS_DB, PROCESS_CANDS
+def init(tokenizer_class, tokenizer_opts, candidates=None):
+    global PROCESS_TOK, PROCESS_CANDS
     PROCESS_TOK = tokenizer_class(**tokenizer_opts)
     Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
-    PROCESS_DB = db_class(**db_opts)
-    Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
     PROCESS_CANDS = candidates
 
 
-def fetch_text(doc_id):
-    global PROCESS_DB
-    return PROCESS_DB.get_doc_text(doc_id)
-
-
 def tokenize_text(text):
     global PROCESS_TOK
     return PROCESS_TOK.tokenize(text)
@@ -76,7 +68,8 @@ class DrQA(object):
             max_loaders=5,
             num_workers=None,
             db_config=None,
-            ranker_config=None
+            ranker_config=None,
+            token_store=None
     ):
         """Initialize the pipeline.
 
@@ -96,6 +89,9 @@ class DrQA(object):
               and post processing resuls.
             db_config: config for doc db.
             ranker_config: config for ranker.
+            token_store: path to pre-tokenized paragraphs of the doc db (see
+              scripts/pipeline/pretokenize.py). Paragraphs missing from it
+              are tokenized live.
         """
         self.batch_size = batch_size
         self.max_loaders = max_loaders
@@ -133,19 +129,52 @@ class DrQA(object):
         db_opts = db_config.get('options', {})
 
         logger.info('Initializing tokenizers and document retrievers...')
+        self.db = db_class(**db_opts)
         self.num_workers = num_workers
         self.processes = ProcessPool(
             num_workers,
             initializer=init,
-            initargs=(tok_class, tok_opts, db_class, db_opts, fixed_candidates)
+            initargs=(tok_class, tok_opts, fixed_candidates)
         )
 
-    def _split_doc(self, doc):
-        """Given a doc, split it into chunks (by paragraph)."""
+        self.token_store = None
+        if token_store:
+            logger.info('Loading token store %s...' % token_store)
+            self.token_store = self._load_token_store(token_store, tok_class,
+                                                      annotators)
+
+    def _load_token_store(self, path, tok_class, annotators):
+        """Load a token store, or None if its tokens differ from those of
+        the pipeline tokenizer (other tokenizer, options or annotators).
+        """
+        token_store = retriever.get_class('tokens')(path)
+        missing = annotators - token_store.annotators
+        if missing:
+            logger.warning('Token store lacks annotators %s, not using '
+                           'it' % missing)
+            return None
+        try:
+            store_class = tokenizers.get_class(token_store.tokenizer)
+        except RuntimeError:
+            store_class = None
+        if store_class is not tok_class:
+            logger.warning('Token store was made by the %s tokenizer, not '
+                           '%s, not using it' %
+                           (token_store.tokenizer, tok_class.__name__))
+            return None
+        # Options of the pipeline tokenizer's Tokens (e.g. non_ent).
+        opts = self.processes.apply(tokenize_text, ('token',)).opts
+        if opts != token_store.opts:
+            logger.warning('Token store has tokenizer options %s, not %s, '
+                           'not using it' % (token_store.opts, opts))
+            return None
+        return token_store
+
+    def _group_paragraphs(self, paragraphs):
+        """Given the paragraphs of a doc, group them into chunks."""
         curr = []
         curr_len = 0
-        for split in regex.split(r'\n+', doc):
-            split = split.strip()
+        for split in paragraphs:
             if len(split) == 0:
                 continue
             # Maybe group paragraphs together until we hit a length limit
@@ -201,28 +230,47 @@ class DrQA(object):
             )
         all_docids, all_doc_scores = zip(*ranked)
 
-        # Flatten document ids and retrieve text from database.
-        # We remove duplicates for processing efficiency.
+        # Flatten document ids and retrieve their paragraphs from database
+        # (in a few batched queries). We remove duplicates for processing
+        # efficiency.
         flat_docids = list({d for docids in all_docids for d in docids})
         did2didx = {did: didx for didx, did in enumerate(flat_docids)}
-        doc_texts = self.processes.map(fetch_text, flat_docids)
+        doc_paragraphs = self.db.get_docs_paragraphs(flat_docids)
 
-        # Split and flatten documents. Maintain a mapping from doc (index in
+        # Group and flatten paragraphs. Maintain a mapping from doc (index in
         # flat list) to split (index in flat list).
         flat_splits = []
         didx2sidx = []
-        for text in doc_texts:
-            splits = self._split_doc(text)
+        for paragraphs in doc_paragraphs:
+            splits = self._group_paragraphs(paragraphs)
             didx2sidx.append([len(flat_splits), -1])
             for split in splits:
                 flat_splits.append(split)
             didx2sidx[-1][1] = len(flat_splits)
 
-        # Push through the tokenizers as fast as possible.
+        # Read pre-tokenized paragraphs (splits are single paragraphs if they
+        # are not grouped).
+        s_tokens = [None] * len(flat_splits)
+        if self.token_store is not None and self.GROUP_LENGTH == 0:
+            for didx, (start, end) in enumerate(didx2sidx):
+                for sidx in range(start, end):
+                    s_tokens[sidx] = self.token_store.get_tokens(
+                        flat_docids[didx], sidx - start, flat_splits[sidx]
+                    )
+        misses = [sidx for sidx, tokens in enumerate(s_tokens)
+                  if tokens is None]
+        if self.token_store is not None:
+            logger.info('Token store: %d/%d paragraphs' %
+                        (len(flat_splits) - len(misses), len(flat_splits)))
+
+        # Push the rest through the tokenizers as fast as possible.
         q_tokens = self.processes.map_async(tokenize_text, queries)
-        s_tokens = self.processes.map_async(tokenize_text, flat_splits)
+        m_tokens = self.processes.map_async(
+            tokenize_text, [flat_splits[sidx] for sidx in misses]
+        )
         q_tokens = q_tokens.get()
-        s_tokens = s_tokens.get()
+        for sidx, tokens in zip(misses, m_tokens.get()):
+            s_tokens[sidx] = tokens
 
         # Group into structured example inputs. Examples' ids represent
         # mappings to their question, document, and split ids.
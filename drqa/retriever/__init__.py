@@ -10,6 +10,7 @@ from .. import DATA_DIR
 
 DEFAULTS = {
     'db_path': os.path.join(DATA_DIR, 'wikipedia/docs.db'),
+    'flat_db_path': os.path.join(DATA_DIR, 'wikipedia/docs-flat'),
     'tfidf_path': os.path.join(
         DATA_DIR,
         'wikipedia/docs-tfidf-ngram=2-hash=16777216-tokenizer=simple.npz'
@@ -25,10 +26,28 @@ def set_default(key, value):
 def get_class(name):
     if name == 'tfidf':
         return TfidfDocRanker
+    if name == 'maxscore':
+        return MaxScoreDocRanker
+    if name == 'twostage':
+        return TwoStageDocRanker
+    if name == 'sharded':
+        return ShardedTfidfRanker
+    if name == 'fts5':
+        return Fts5DocRanker
     if name == 'sqlite':
         return DocDB
+    if name == 'flat':
+        return FlatDocDB
+    if name == 'tokens':
+        return TokenStore
     raise RuntimeError('Invalid retriever class: %s' % name)
 
 
 from .doc_db import DocDB
+from .flat_doc_db import FlatDocDB
 from .tfidf_doc_ranker import TfidfDocRanker
+from .maxscore_doc_ranker import MaxScoreDocRanker
+from .sharded_tfidf_ranker import ShardedTfidfRanker
+from .two_stage_doc_ranker import TwoStageDocRanker
+from .fts5_doc_ranker import Fts5DocRanker
+from .token_store import TokenStore
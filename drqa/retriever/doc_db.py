@@ -6,20 +6,99 @@
 # LICENSE file in the root directory of this source tree.
 """Documents, in a sqlite database."""
 
+import os
 import sqlite3
+import threading
+import weakref
+from urllib.request import pathname2url
 from . import utils
 from . import DEFAULTS
 
 
+class _ConnectionOwner(object):
+    """Stored in a thread's local data: its connection lives as long."""
+
+
+def _close_connection(connections, lock, key):
+    """Close a read-only connection (unless DocDB.close already did)."""
+    with lock:
+        connection = connections.pop(key, None)
+    if connection is not None:
+        connection.close()
+
+
 class DocDB(object):
     """Sqlite backed document storage.
 
     Implements get_doc_text(doc_id).
+
+    Texts may be stored compressed (see build_db.py --compress), and are
+    decompressed transparently.
+
+    In read_only mode (for serving), the file is opened read-only and
+    immutable (no locking or change detection), and every thread gets its
+    own connection, with its own page cache and cache of prepared
+    statements, so concurrent lookups do not serialize on one connection.
+    A thread's connection is closed when the thread ends.
     """
+    # Max number of ids bound in one "IN (...)" query (older sqlite versions
+    # allow at most 999 variables per statement).
+    MAX_QUERY_IDS = 900
 
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, read_only=False, mmap_size=2 ** 30,
+                 cache_size=64):
+        """
+        Args:
+            db_path: path to the sqlite db
+            read_only: open in read-only serving mode. The db must not be
+              modified while it is open.
+            mmap_size: bytes of the file to memory-map (read_only mode)
+            cache_size: page cache size per connection, in MB (read_only
+              mode)
+        """
         self.path = db_path or DEFAULTS['db_path']
-        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.local = threading.local()
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        if not read_only:
+            self.shared_connection = sqlite3.connect(self.path,
+                                                     check_same_thread=False)
+        self.codec = self.get_codec()
+        self.has_paragraphs = self._has_table('paragraphs')
+
+    @property
+    def connection(self):
+        """sqlite connection to use (the calling thread's in read_only
+        mode).
+        """
+        if not self.read_only:
+            return self.shared_connection
+        if not hasattr(self.local, 'connection'):
+            connection = self._connect_read_only()
+            with self.connections_lock:
+                self.connections[id(connection)] = connection
+            self.local.connection = connection
+            # The thread-local data (and this owner) is freed when the
+            # thread ends, which closes its connection.
+            self.local.owner = _ConnectionOwner()
+            weakref.finalize(self.local.owner, _close_connection,
+                             self.connections, self.connections_lock,
+                             id(connection))
+        return self.local.connection
+
+    def _connect_read_only(self):
+        if not os.path.isfile(self.path):
+            raise RuntimeError('No such db: %s' % self.path)
+        uri = 'file:%s?mode=ro&immutable=1' % pathname2url(
+            os.path.abspath(self.path)
+        )
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        connection.execute('PRAGMA mmap_size = %d' % self.mmap_size)
+        connection.execute('PRAGMA cache_size = %d' % (-1024 * self.cache_size))
+        return connection
 
     def __enter__(self):
         return self
@@ -32,8 +111,35 @@ class DocDB(object):
         return self.path
 
     def close(self):
-        """Close the connection to the database."""
-        self.connection.close()
+        """Close the connection(s) to the database."""
+        if not self.read_only:
+            self.shared_connection.close()
+        with self.connections_lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+    def _has_table(self, name):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE name = ?",
+                       (name,))
+        result = cursor.fetchone()
+        cursor.close()
+        return result is not None
+
+    def get_codec(self):
+        """Codec of the stored texts, recorded in the meta table by
+        build_db.py (texts are uncompressed if there is none).
+        """
+        if not self._has_table('meta'):
+            return utils.TextCodec()
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT key, value FROM meta")
+        meta = dict(cursor.fetchall())
+        cursor.close()
+        return utils.TextCodec(meta.get('codec', 'none'),
+                               dictionary=meta.get('zstd_dict'))
 
     def get_doc_ids(self):
         """Fetch all ids of docs stored in the db."""
@@ -43,6 +149,69 @@ class DocDB(object):
         cursor.close()
         return results
 
+    def get_num_docs(self):
+        """Number of docs stored in the db."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM documents")
+        result = cursor.fetchone()[0]
+        cursor.close()
+        return result
+
+    def get_rowid_bounds(self):
+        """[start, end) range of the rowids of the docs ((0, 0) if empty)."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT MIN(rowid), MAX(rowid) FROM documents")
+        min_rowid, max_rowid = cursor.fetchone()
+        cursor.close()
+        if min_rowid is None:
+            return 0, 0
+        return min_rowid, max_rowid + 1
+
+    def get_rowid_ranges(self, range_size=1000, start=None, end=None):
+        """Split the rowids of the docs (or of [start, end)) into contiguous
+        [start, end) ranges of range_size rowids, in order. Ranges hold at
+        most range_size docs (fewer where docs were deleted).
+        """
+        min_rowid, max_rowid = self.get_rowid_bounds()
+        start = min_rowid if start is None else max(start, min_rowid)
+        end = max_rowid if end is None else min(end, max_rowid)
+        return [(i, min(i + range_size, end))
+                for i in range(start, end, range_size)]
+
+    def iter_doc_ids(self, start=None, end=None, batch_size=1000):
+        """Stream (rowid, id) pairs of the docs, in rowid order, optionally
+        within rowids [start, end). Ids are fetched batch_size at a time.
+        """
+        for rowid, doc_id, _ in self._iter_rows("id", start, end,
+                                                batch_size):
+            yield rowid, doc_id
+
+    def iter_docs(self, start=None, end=None, batch_size=100):
+        """Stream (rowid, id, text) triples of the docs, like iter_doc_ids.
+        """
+        for rowid, doc_id, text in self._iter_rows("id, text", start, end,
+                                                   batch_size):
+            yield rowid, doc_id, self.codec.decompress(text)
+
+    def _iter_rows(self, columns, start, end, batch_size):
+        # Page on rowid, so no statement stays open between batches.
+        start = -2 ** 63 if start is None else start
+        end = 2 ** 63 - 1 if end is None else end
+        while True:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                "SELECT rowid, %s FROM documents WHERE rowid >= ? AND "
+                "rowid < ? ORDER BY rowid LIMIT ?" % columns,
+                (start, end, batch_size)
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+            for row in rows:
+                yield row if len(row) == 3 else row + (None,)
+            if len(rows) < batch_size:
+                return
+            start = rows[-1][0] + 1
+
     def get_doc_text(self, doc_id):
         """Fetch the raw text of the doc for 'doc_id'."""
         cursor = self.connection.cursor()
@@ -52,4 +221,52 @@ class DocDB(object):
         )
         result = cursor.fetchone()
         cursor.close()
-        return result if result is None else result[0]
+        return result if result is None else self.codec.decompress(result[0])
+
+    def get_doc_texts(self, doc_ids):
+        """Fetch the raw texts of many docs, in the order of 'doc_ids' (None
+        for unknown ids), with a few "IN (...)" queries on one connection.
+        """
+        doc_ids = [utils.normalize(doc_id) for doc_id in doc_ids]
+        texts = {}
+        cursor = self.connection.cursor()
+        for i in range(0, len(doc_ids), self.MAX_QUERY_IDS):
+            chunk = list(set(doc_ids[i:i + self.MAX_QUERY_IDS]))
+            cursor.execute(
+                "SELECT id, text FROM documents WHERE id IN (%s)" %
+                ', '.join('?' * len(chunk)), chunk
+            )
+            texts.update(cursor.fetchall())
+        cursor.close()
+        return [self.codec.decompress(texts.get(doc_id)) for doc_id in doc_ids]
+
+    def get_doc_paragraphs(self, doc_id):
+        """Fetch the paragraphs of the doc for 'doc_id' (see
+        utils.split_paragraphs), stored at ingest time if the db has a
+        paragraphs table. Empty for unknown ids.
+        """
+        return self.get_docs_paragraphs([doc_id])[0]
+
+    def get_docs_paragraphs(self, doc_ids):
+        """Fetch the paragraph lists of many docs, in the order of 'doc_ids'.
+        Docs are split on the fly if the db has no paragraphs table.
+        """
+        if not self.has_paragraphs:
+            return [[] if text is None else utils.split_paragraphs(text)
+                    for text in self.get_doc_texts(doc_ids)]
+
+        doc_ids = [utils.normalize(doc_id) for doc_id in doc_ids]
+        paragraphs = {}
+        cursor = self.connection.cursor()
+        for i in range(0, len(doc_ids), self.MAX_QUERY_IDS):
+            chunk = list(set(doc_ids[i:i + self.MAX_QUERY_IDS]))
+            cursor.execute(
+                "SELECT doc_id, text FROM paragraphs WHERE doc_id IN (%s) "
+                "ORDER BY doc_id, idx" % ', '.join('?' * len(chunk)), chunk
+            )
+            for doc_id, text in cursor.fetchall():
+                paragraphs.setdefault(doc_id, []).append(
+                    self.codec.decompress(text)
+                )
+        cursor.close()
+        return [list(paragraphs.get(doc_id, [])) for doc_id in doc_ids]
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Documents, in one memory-mapped blob."""
+
+import os
+import json
+import numpy as np
+
+from . import utils
+from . import DEFAULTS
+
+
+class FlatDocDB(object):
+    """Read-only document storage in flat files (see build_flat_db.py).
+
+    Implements the DocDB interface (get_doc_text, get_doc_texts,
+    get_docs_paragraphs, ...) for serving.
+
+    All texts are concatenated (utf-8) in one memory-mapped blob, with the
+    start offset of every doc index. When built against a tf-idf model, doc
+    indices are the model's (its doc_dict), so get_index_text resolves
+    ranker results without any lookup. Paragraphs are spans of the blob.
+    A text is a slice of the mapped pages, only copied when decoded; there
+    is no connection to open and nothing to lock, in any thread or process.
+    """
+    ARRAYS = {'text': '|u1', 'offsets': '<i8', 'para_ptr': '<i8',
+              'para_start': '<i8', 'para_end': '<i8'}
+
+    def __init__(self, db_path=None):
+        """
+        Args:
+            db_path: path to the directory written by build_flat_db.py
+        """
+        self.path = db_path or DEFAULTS['flat_db_path']
+        if not os.path.isfile(os.path.join(self.path, 'header.json')):
+            raise RuntimeError('No such flat db: %s' % self.path)
+        with open(os.path.join(self.path, 'header.json')) as f:
+            header = json.load(f)
+        self.tfidf_path = header.get('tfidf_path')
+        self.arrays = {name: self._load_raw(name, dtype, length)
+                       for name, (dtype, length) in header['arrays'].items()}
+        self.blob = memoryview(self.arrays['text'])
+        self.doc_dict = utils.DocDict(*[
+            np.load(os.path.join(self.path, 'doc_ids.%s.npy' % array),
+                    mmap_mode='r')
+            for array in utils.DocDict.ARRAYS
+        ])
+        self.has_paragraphs = True
+
+    def _load_raw(self, name, dtype, length):
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype,
+                         mode='r', shape=(length,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Drop the mapped arrays (unmapped once no slice refers to them)."""
+        self.arrays = {}
+        self.blob = None
+        self.doc_dict = None
+
+    def __len__(self):
+        return len(self.doc_dict)
+
+    def get_doc_ids(self):
+        """Fetch all ids of docs stored in the db, in doc index order."""
+        return list(self.doc_dict)
+
+    def get_doc_index(self, doc_id):
+        """Convert doc_id --> doc_index (None for unknown ids)."""
+        try:
+            return self.doc_dict.get_index(utils.normalize(doc_id))
+        except KeyError:
+            return None
+
+    def _text(self, start, end):
+        return str(self.blob[start:end], 'utf-8')
+
+    def get_index_text(self, doc_index):
+        """Fetch the raw text of the doc at 'doc_index'."""
+        offsets = self.arrays['offsets']
+        return self._text(offsets[doc_index], offsets[doc_index + 1])
+
+    def get_doc_text(self, doc_id):
+        """Fetch the raw text of the doc for 'doc_id' (None if unknown)."""
+        doc_index = self.get_doc_index(doc_id)
+        return None if doc_index is None else self.get_index_text(doc_index)
+
+    def get_doc_texts(self, doc_ids):
+        """Fetch the raw texts of many docs, in the order of 'doc_ids' (None
+        for unknown ids).
+        """
+        return [self.get_doc_text(doc_id) for doc_id in doc_ids]
+
+    def get_index_paragraphs(self, doc_index):
+        """Fetch the paragraphs of the doc at 'doc_index'."""
+        para_ptr = self.arrays['para_ptr']
+        start, end = para_ptr[doc_index], para_ptr[doc_index + 1]
+        return [self._text(s, e) for s, e in zip(
+            self.arrays['para_start'][start:end].tolist(),
+            self.arrays['para_end'][start:end].tolist()
+        )]
+
+    def get_doc_paragraphs(self, doc_id):
+        """Fetch the paragraphs of the doc for 'doc_id' (see
+        utils.split_paragraphs). Empty for unknown ids.
+        """
+        doc_index = self.get_doc_index(doc_id)
+        if doc_index is None:
+            return []
+        return self.get_index_paragraphs(doc_index)
+
+    def get_docs_paragraphs(self, doc_ids):
+        """Fetch the paragraph lists of many docs, in the order of 'doc_ids'.
+        """
+        return [self.get_doc_paragraphs(doc_id) for doc_id in doc_ids]
+
+
+class FlatDocDBWriter(object):
+    """Writes a FlatDocDB, one document at a time, in doc index order."""
+
+    def __init__(self, path, tfidf_path=None):
+        """
+        Args:
+            path: output directory (must not hold a flat db already)
+            tfidf_path: tf-idf model whose doc indices are used (recorded in
+              the header)
+        """
+        if os.path.isfile(os.path.join(path, 'header.json')):
+            raise RuntimeError('%s already exists! Not overwriting.' % path)
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.tfidf_path = tfidf_path
+        self.doc_ids = []
+        self.lengths = {name: 0 for name in FlatDocDB.ARRAYS}
+        self.files = {name: open(os.path.join(path, name + '.bin'), 'wb')
+                      for name in FlatDocDB.ARRAYS}
+        self.num_bytes = 0
+        self.num_paragraphs = 0
+        self._write('offsets', [0])
+        self._write('para_ptr', [0])
+
+    def _write(self, name, values):
+        array = np.asarray(values, dtype=FlatDocDB.ARRAYS[name])
+        self.files[name].write(array.tobytes())
+        self.lengths[name] += len(array)
+
+    def add(self, doc_id, text, paragraphs):
+        """Add a document: its text, and its paragraphs (substrings of the
+        text, in order).
+        """
+        encoded = text.encode('utf-8')
+        starts, ends = [], []
+        pos = 0
+        for paragraph in paragraphs:
+            paragraph = paragraph.encode('utf-8')
+            start = encoded.find(paragraph, pos)
+            if start < 0:
+                raise RuntimeError('Paragraph %d of %s is not part of its '
+                                   'text' % (len(starts), doc_id))
+            pos = start + len(paragraph)
+            starts.append(self.num_bytes + start)
+            ends.append(self.num_bytes + pos)
+        self._write('text', np.frombuffer(encoded, dtype=np.uint8))
+        self.num_bytes += len(encoded)
+        self._write('offsets', [self.num_bytes])
+        self._write('para_start', starts)
+        self._write('para_end', ends)
+        self.num_paragraphs += len(starts)
+        self._write('para_ptr', [self.num_paragraphs])
+        self.doc_ids.append(doc_id)
+
+    def close(self):
+        """Save the doc ids and header."""
+        for f in self.files.values():
+            f.close()
+        doc_dict = utils.DocDict.from_ids(self.doc_ids)
+        for array, values in doc_dict.arrays().items():
+            np.save(os.path.join(self.path, 'doc_ids.%s.npy' % array), values)
+        header = {
+            'tfidf_path': self.tfidf_path,
+            'arrays': {name: [dtype, self.lengths[name]]
+                       for name, dtype in FlatDocDB.ARRAYS.items()},
+        }
+        with open(os.path.join(self.path, 'header.json'), 'w') as f:
+            json.dump(header, f)
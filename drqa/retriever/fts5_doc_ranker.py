@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Rank documents with BM25 scores, from an SQLite FTS5 index."""
+
+import logging
+import sqlite3
+import threading
+import numpy as np
+
+from multiprocessing.pool import ThreadPool
+from functools import partial
+
+from . import utils
+from . import DEFAULTS
+from .. import tokenizers
+
+logger = logging.getLogger(__name__)
+
+
+class Fts5DocRanker(object):
+    """Ranks the documents of a DocDB with an FTS5 full-text index stored in
+    the same sqlite file (see build_fts5.py).
+
+    The index stays on disk and is read through the page cache, so memory
+    use is a small fraction of TfidfDocRanker's. Queries are tokenized and
+    stopword/punctuation filtered like for tf-idf, and their words OR'ed
+    together; scores are negated FTS5 bm25() values (higher is better).
+    Implements the closest_docs/batch_closest_docs interface of
+    TfidfDocRanker.
+    """
+    TABLE = 'documents_fts'
+
+    def __init__(self, db_path=None, strict=True, tokenizer='simple'):
+        """
+        Args:
+            db_path: path to the document db holding the FTS5 index
+            strict: fail on empty queries or continue (and return empty result)
+            tokenizer: tokenizer used to split queries into words
+        """
+        self.db_path = db_path or DEFAULTS['db_path']
+        self.strict = strict
+        self.tokenizer = tokenizers.get_class(tokenizer)()
+        self.local = threading.local()
+        cursor = self.connection().cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE name = ?",
+                       (self.TABLE,))
+        if cursor.fetchone() is None:
+            raise RuntimeError('No FTS5 index in %s (run build_fts5.py)' %
+                               self.db_path)
+        cursor.close()
+
+    def connection(self):
+        """sqlite connection of the calling thread."""
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(self.db_path,
+                                                    check_same_thread=False)
+        return self.local.connection
+
+    def get_doc_index(self, doc_id):
+        """Convert doc_id --> doc_index (the document rowid)"""
+        cursor = self.connection().cursor()
+        cursor.execute("SELECT rowid FROM documents WHERE id = ?",
+                       (utils.normalize(doc_id),))
+        result = cursor.fetchone()
+        cursor.close()
+        if result is None:
+            raise KeyError(doc_id)
+        return result[0]
+
+    def get_doc_id(self, doc_index):
+        """Convert doc_index --> doc_id"""
+        cursor = self.connection().cursor()
+        cursor.execute("SELECT id FROM documents WHERE rowid = ?",
+                       (int(doc_index),))
+        result = cursor.fetchone()
+        cursor.close()
+        if result is None:
+            raise KeyError(doc_index)
+        return result[0]
+
+    def parse(self, query):
+        """Parse the query into an FTS5 match expression."""
+        tokens = self.tokenizer.tokenize(utils.normalize(query))
+        words = []
+        for word in tokens.words(uncased=True):
+            if not utils.filter_word(word) and word not in words:
+                words.append(word)
+        return ' OR '.join('"%s"' % w.replace('"', '""') for w in words)
+
+    def closest_docs(self, query, k=1):
+        """Closest docs by BM25 score."""
+        expression = self.parse(query)
+        if not expression:
+            if self.strict:
+                raise RuntimeError('No valid word in: %s' % query)
+            logger.warning('No valid word in: %s' % query)
+            return [], np.array([])
+
+        cursor = self.connection().cursor()
+        cursor.execute(
+            "SELECT d.id, -bm25(%s) FROM %s JOIN documents d "
+            "ON d.rowid = %s.rowid WHERE %s MATCH ? ORDER BY rank LIMIT ?"
+            % ((self.TABLE,) * 4), (expression, k)
+        )
+        results = cursor.fetchall()
+        cursor.close()
+        doc_ids = [r[0] for r in results]
+        doc_scores = np.array([r[1] for r in results])
+        return doc_ids, doc_scores
+
+    def batch_closest_docs(self, queries, k=1, num_workers=None):
+        """Process a batch of closest_docs requests multithreaded (sqlite
+        releases the GIL while searching; each thread gets a connection).
+        """
+        with ThreadPool(num_workers) as threads:
+            closest_docs = partial(self.closest_docs, k=k)
+            results = threads.map(closest_docs, queries)
+        return results
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Rank documents with TF-IDF scores, with early-terminating top-k search."""
+
+import logging
+import threading
+import numpy as np
+
+from . import utils
+from .tfidf_doc_ranker import TfidfDocRanker
+
+logger = logging.getLogger(__name__)
+
+
+class MaxScoreDocRanker(TfidfDocRanker):
+    """Loads a pre-weighted inverted index of token/document terms.
+    Finds the top-k documents without scoring every matching document.
+
+    Each query term's postings (a row of doc_mat) are read in impact order,
+    i.e. by decreasing tf-idf weight. All documents seen so far are scored
+    exactly, and reading stops once the weights at the read frontier of
+    every term can no longer add up to the current k-th best score. Terms
+    whose frontier bounds together stay under that score are non-essential
+    (MaxScore) and are not read any further. The top-k is the same as the
+    exhaustive TfidfDocRanker's (up to ties).
+    """
+    # Number of postings read per term in the first round (doubled after).
+    BLOCK_SIZE = 64
+
+    def __init__(self, tfidf_path=None, strict=True, check=False,
+                 cache_size=0, max_terms=None, weight_frac=None):
+        """
+        Args:
+            tfidf_path: path to saved model file
+            strict: fail on empty queries or continue (and return empty result)
+            check: also score every query exhaustively and log any difference
+              in the ranking (test mode)
+            cache_size: size of the query vector and result LRU caches
+            max_terms, weight_frac: default query-term pruning budget
+        """
+        super(MaxScoreDocRanker, self).__init__(
+            tfidf_path, strict, cache_size=cache_size, max_terms=max_terms,
+            weight_frac=weight_frac
+        )
+        self.check = check
+        if self.scales is not None:
+            raise RuntimeError('MaxScoreDocRanker does not support '
+                               'quantized models')
+
+        # Exact scoring binary searches the postings, so they must be sorted.
+        impact_order = self.metadata.get('impact_order')
+        max_weights = self.metadata.get('max_weights')
+        if not self.doc_mat.has_sorted_indices:
+            logger.info('Sorting postings (rebuild with --impact-order to '
+                        'skip this)...')
+            self.doc_mat = self.doc_mat.sorted_indices()
+            impact_order = None
+        if impact_order is None:
+            logger.info('Computing impact order of postings...')
+            impact_order = utils.get_impact_order(self.doc_mat)
+        if max_weights is None:
+            max_weights = utils.get_max_weights(self.doc_mat)
+        self.impact_order = impact_order
+        self.max_weights = max_weights
+
+        # Postings read vs. total postings of the query terms, and number of
+        # differences found in test mode. Updated from batch threads.
+        self.stats = {'queries': 0, 'read': 0, 'total': 0, 'diffs': 0}
+        self.stats_lock = threading.Lock()
+
+    def load_delta(self, delta_path):
+        """Delta segments are not supported (postings are impact ordered)."""
+        if delta_path:
+            raise RuntimeError('MaxScoreDocRanker does not support '
+                               'delta segments, compact them first')
+        super(MaxScoreDocRanker, self).load_delta(delta_path)
+
+    def _closest_docs(self, query, k=1, budget=(None, None)):
+        """Rank a single query (uncached)."""
+        spvec = self.query_vector(query, budget)
+        doc_indices, doc_scores = self.top_k(spvec.indices, spvec.data, k)
+        doc_ids = [self.get_doc_id(i) for i in doc_indices]
+        if self.check:
+            self._check(query, k, budget, doc_ids, doc_scores)
+        return doc_ids, doc_scores
+
+    def _batch_closest_docs(self, queries, k=1, budget=(None, None)):
+        """Rank a chunk of queries one by one (pruning is per query)."""
+        return [self._closest_docs(q, k, budget) for q in queries]
+
+    def top_k(self, terms, weights, k):
+        """Find the k best documents for a weighted set of hashed terms.
+
+        Returns:
+            doc_indices, doc_scores: sorted by decreasing score.
+        """
+        indptr = self.doc_mat.indptr
+        keep = (weights > 0) & (indptr[terms + 1] > indptr[terms])
+        terms, weights = terms[keep], weights[keep]
+        starts = indptr[terms]
+        lengths = indptr[terms + 1] - starts
+        depths = np.zeros(len(terms), dtype=lengths.dtype)
+        candidates = np.zeros(0, dtype=self.doc_mat.indices.dtype)
+        scores = np.zeros(0)
+        threshold = 0
+
+        while True:
+            # Upper bound on the weight of any posting not read yet.
+            exhausted = depths == lengths
+            frontier = np.zeros(len(terms))
+            frontier[depths == 0] = self.max_weights[terms[depths == 0]]
+            reading = ~exhausted & (depths > 0)
+            frontier[reading] = self.doc_mat.data[
+                self.impact_order[starts[reading] + depths[reading]]
+            ]
+            frontier *= weights
+            if frontier.sum() <= threshold:
+                break
+
+            # Only read further into essential terms: the ones that are not
+            # part of the smallest bounds summing up to the threshold.
+            order = np.argsort(frontier)
+            essential = np.zeros(len(terms), dtype=bool)
+            essential[order[np.cumsum(frontier[order]) > threshold]] = True
+            grow = essential & ~exhausted
+            depths[grow] = np.minimum(
+                np.maximum(2 * depths[grow], self.BLOCK_SIZE), lengths[grow]
+            )
+
+            # Score all documents seen so far exactly.
+            candidates = np.unique(np.concatenate([candidates] + [
+                self.doc_mat.indices[self.impact_order[s:s + d]]
+                for s, d in zip(starts, depths)
+            ]))
+            scores = np.zeros(len(candidates))
+            for term, weight in zip(terms, weights):
+                scores += weight * utils.get_row_values(
+                    self.doc_mat, term, candidates
+                )
+            if len(scores) >= k:
+                threshold = np.partition(scores, -k)[-k]
+
+        with self.stats_lock:
+            self.stats['queries'] += 1
+            self.stats['read'] += int(depths.sum())
+            self.stats['total'] += int(lengths.sum())
+
+        if len(scores) <= k:
+            o_sort = np.argsort(-scores)
+        else:
+            o = np.argpartition(-scores, k)[0:k]
+            o_sort = o[np.argsort(-scores[o])]
+        return candidates[o_sort], scores[o_sort]
+
+    def _check(self, query, k, budget, doc_ids, doc_scores):
+        """Compare a ranking with the exhaustive TfidfDocRanker one."""
+        exact_ids, exact_scores = super(MaxScoreDocRanker, self)._closest_docs(
+            query, k, budget
+        )
+        if (len(exact_scores) != len(doc_scores) or
+                not np.allclose(exact_scores, doc_scores)):
+            logger.warning('Ranking differs for query: %s\n'
+                           'exhaustive: %s %s\npruned: %s %s' %
+                           (query, exact_ids, exact_scores,
+                            doc_ids, doc_scores))
+            with self.stats_lock:
+                self.stats['diffs'] += 1
+        elif exact_ids != doc_ids:
+            logger.debug('Ties ordered differently for query: %s' % query)
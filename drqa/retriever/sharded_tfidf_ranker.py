@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Rank documents with TF-IDF scores, over shards of the document set."""
+
+import bisect
+import glob
+import heapq
+import logging
+import numpy as np
+import scipy.sparse as sp
+
+from multiprocessing.pool import ThreadPool
+
+from . import utils
+from . import DEFAULTS
+from .tfidf_doc_ranker import TfidfDocRanker
+from .. import tokenizers
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedTfidfRanker(TfidfDocRanker):
+    """Loads N shards of a pre-weighted inverted index, each covering a
+    disjoint range of documents and sharing the global doc_freqs (see
+    build_tfidf.py --num-shards).
+
+    Queries are encoded once, scored on every shard in parallel threads, and
+    the per-shard top-k lists are merged with a heap. Implements the same
+    interface as TfidfDocRanker; doc indices are global (shard offset +
+    index within the shard).
+    """
+
+    def __init__(self, tfidf_paths=None, strict=True, num_workers=None,
+                 cache_size=0, max_terms=None, weight_frac=None):
+        """
+        Args:
+            tfidf_paths: list of shard files, or a glob pattern matching them
+            strict: fail on empty queries or continue (and return empty result)
+            num_workers: number of threads scoring shards (default: one per
+              shard)
+            cache_size: size of the query vector and result LRU caches
+            max_terms, weight_frac: default query-term pruning budget
+        """
+        tfidf_paths = tfidf_paths or DEFAULTS['tfidf_path']
+        if isinstance(tfidf_paths, str):
+            tfidf_paths = sorted(glob.glob(tfidf_paths))
+        if not tfidf_paths:
+            raise RuntimeError('No tf-idf shards found')
+
+        # Load shards from disk, in shard order.
+        shards = []
+        for path in tfidf_paths:
+            logger.info('Loading %s' % path)
+            shards.append(utils.load_sparse_csr(path))
+        shards.sort(key=lambda shard: shard[1].get('shard', 0))
+        metadata = shards[0][1]
+        num_shards = metadata.get('num_shards', 1)
+        if [m.get('shard', 0) for _, m in shards] != list(range(num_shards)):
+            raise RuntimeError('Expected shards 0..%d of a %d-shard model' %
+                               (num_shards - 1, num_shards))
+
+        self.doc_mats = [matrix for matrix, _ in shards]
+        self.shard_scales = [m.get('scales') for _, m in shards]
+        self.doc_dicts = [m['doc_dict'] for _, m in shards]
+        self.offsets = [0]
+        for doc_dict in self.doc_dicts:
+            self.offsets.append(self.offsets[-1] + len(doc_dict))
+
+        self.metadata = metadata
+        self.ngrams = metadata['ngram']
+        self.hash_size = metadata['hash_size']
+        self.tokenizer = tokenizers.get_class(metadata['tokenizer'])()
+        self.doc_freqs = metadata['doc_freqs'].squeeze()
+        self.num_docs = self.offsets[-1]
+        self.strict = strict
+        self.max_terms = max_terms
+        self.weight_frac = weight_frac
+        self.threads = ThreadPool(num_workers or len(shards))
+        self.query_cache = utils.LRUCache(cache_size) if cache_size else None
+        self.result_cache = utils.LRUCache(cache_size) if cache_size else None
+
+    def load_delta(self, delta_path):
+        """Delta segments are not supported on sharded models."""
+        if delta_path:
+            raise RuntimeError('ShardedTfidfRanker does not support '
+                               'delta segments')
+
+    @classmethod
+    def attach(cls, name, **kwargs):
+        raise RuntimeError('ShardedTfidfRanker does not support '
+                           'shared memory')
+
+    def publish(self, name=None):
+        """Shared memory is not supported on sharded models."""
+        raise RuntimeError('ShardedTfidfRanker does not support '
+                           'shared memory')
+
+    def get_doc_index(self, doc_id):
+        """Convert doc_id --> doc_index"""
+        for offset, doc_dict in zip(self.offsets, self.doc_dicts):
+            if doc_id in doc_dict:
+                return offset + doc_dict.get_index(doc_id)
+        raise KeyError(doc_id)
+
+    def get_doc_id(self, doc_index):
+        """Convert doc_index --> doc_id"""
+        shard = bisect.bisect_right(self.offsets, doc_index) - 1
+        return self.doc_dicts[shard].get_id(doc_index - self.offsets[shard])
+
+    def scores(self, spvecs):
+        """Score query vectors against all documents (one row per query)."""
+        res = self.threads.map(
+            lambda shard: utils.sparse_dot(spvecs, self.doc_mats[shard],
+                                           self.shard_scales[shard]),
+            range(len(self.doc_mats))
+        )
+        return sp.hstack(res, format='csr')
+
+    def _closest_docs(self, query, k=1, budget=(None, None)):
+        """Rank a single query (uncached)."""
+        return self._batch_closest_docs([query], k, budget)[0]
+
+    def _batch_closest_docs(self, queries, k=1, budget=(None, None)):
+        """Score a chunk of queries on all shards, then merge the top-k."""
+        spvecs = sp.vstack([self.query_vector(q, budget) for q in queries],
+                           format='csr')
+
+        def _shard_top_k(shard):
+            res = utils.sparse_dot(spvecs, self.doc_mats[shard],
+                                   self.shard_scales[shard])
+            return [(indices + self.offsets[shard], doc_scores)
+                    for indices, doc_scores in utils.top_k_per_row(res, k)]
+
+        shard_results = self.threads.map(_shard_top_k,
+                                         range(len(self.doc_mats)))
+        results = []
+        for per_shard in zip(*shard_results):
+            top = heapq.nlargest(k, (
+                (score, index) for indices, doc_scores in per_shard
+                for index, score in zip(indices, doc_scores)
+            ))
+            doc_ids = [self.get_doc_id(index) for _, index in top]
+            doc_scores = np.array([score for score, _ in top])
+            results.append((doc_ids, doc_scores))
+        return results
@@ -24,40 +24,195 @@ class TfidfDocRanker(object):
     """Loads a pre-weighted inverted index of token/document terms.
     Scores new queries by taking sparse dot products.
     """
+    # Max number of queries scored together in one sparse matrix product.
+    BATCH_SIZE = 256
 
-    def __init__(self, tfidf_path=None, strict=True):
+    def __init__(self, tfidf_path=None, strict=True, delta_path=None,
+                 cache_size=0, max_terms=None, weight_frac=None):
         """
         Args:
-            tfidf_path: path to saved model file
+            tfidf_path: path to saved model file (.npz file or directory of
+              memory-mapped arrays, see utils.save_sparse_csr_mmap), or
+              shm://<name> of a published model (see attach)
             strict: fail on empty queries or continue (and return empty result)
+            delta_path: path to a delta segment of added/changed/deleted docs
+              to score on top of the model (see update_tfidf.py)
+            cache_size: number of query vectors, and of ranked results, to
+              keep in LRU caches (0 = no caching)
+            max_terms: default query-term budget, see prune_query
+            weight_frac: default query weight fraction, see prune_query
         """
         # Load from disk
         tfidf_path = tfidf_path or DEFAULTS['tfidf_path']
         logger.info('Loading %s' % tfidf_path)
         matrix, metadata = utils.load_sparse_csr(tfidf_path)
         self.doc_mat = matrix
+        self.metadata = metadata
+        self.scales = metadata.get('scales')
         self.ngrams = metadata['ngram']
         self.hash_size = metadata['hash_size']
         self.tokenizer = tokenizers.get_class(metadata['tokenizer'])()
         self.doc_freqs = metadata['doc_freqs'].squeeze()
+        self.zero_idf_tf = metadata.get('zero_idf_tf', False)
         self.doc_dict = metadata['doc_dict']
-        self.num_docs = len(self.doc_dict[0])
+        self.num_docs = len(self.doc_dict)
         self.strict = strict
+        self.max_terms = max_terms
+        self.weight_frac = weight_frac
+
+        # Query vectors (by normalized query) and results (by query and k).
+        self.query_cache = utils.LRUCache(cache_size) if cache_size else None
+        self.result_cache = utils.LRUCache(cache_size) if cache_size else None
+
+        # Base model statistics, kept when a delta segment updates them.
+        self.base_doc_freqs = self.doc_freqs
+        self.base_num_docs = self.num_docs
+        self.delta_mat = None
+        if delta_path:
+            self.load_delta(delta_path)
+
+    @classmethod
+    def attach(cls, name, **kwargs):
+        """Load a model published in shared memory by another process (see
+        publish). The index arrays are not copied: any number of processes
+        can attach for the memory cost of one model.
+        """
+        return cls(tfidf_path=utils.SHM_PREFIX + name, **kwargs)
+
+    def publish(self, name=None):
+        """Copy the base model into a named shared memory segment, for other
+        processes to attach to. This ranker then also reads from the segment
+        (so its own copy can be freed). Returns the segment name.
+
+        The segment lives until unpublish() is called or this process exits:
+        attached processes must not outlive it. Delta segments are not
+        published (attached rankers can load their own).
+        """
+        self.shm = utils.publish_sparse_csr_shm(self.doc_mat, self.metadata,
+                                                name)
+        matrix, metadata = utils.attach_sparse_csr_shm(self.shm.name)
+        self.doc_mat = matrix
+        self.metadata = metadata
+        self.scales = metadata.get('scales')
+        self.doc_dict = metadata['doc_dict']
+        self.base_doc_freqs = metadata['doc_freqs'].squeeze()
+        if self.delta_mat is None:
+            self.doc_freqs = self.base_doc_freqs
+        logger.info('Published %s (%.1f MB)' %
+                    (self.shm.name, self.shm.size / 1024 ** 2))
+        return self.shm.name
+
+    def unpublish(self):
+        """Unlink the published segment. Its memory is released when the
+        last process attached to it (including this one) exits.
+        """
+        if getattr(self, 'shm', None) is not None:
+            self.shm.unlink()
+            self.shm = None
+
+    def load_delta(self, delta_path):
+        """Load (or reload) a delta segment on top of the base model.
+
+        The segment holds raw ngram counts of added and changed documents,
+        the base indices of deleted (or changed) documents, and the updated
+        doc_freqs. Delta documents get indices after the base ones. Passing
+        None drops the current segment. Clears the caches.
+
+        Older models, which did not keep the tfs of zero idf buckets, can
+        not take a delta that makes these idfs positive (see
+        utils.get_reweighting).
+        """
+        self.clear_cache()
+        if not delta_path:
+            self.delta_mat = None
+            self.doc_freqs = self.base_doc_freqs
+            self.num_docs = self.base_num_docs
+            return
+
+        logger.info('Loading delta %s' % delta_path)
+        counts, metadata = utils.load_sparse_csr(delta_path)
+        if metadata['base_num_docs'] != self.base_num_docs:
+            raise RuntimeError('Delta %s was not built for this model'
+                               % delta_path)
+        doc_freqs = metadata['doc_freqs']
+        num_docs = metadata['num_docs']
+
+        # Delta documents are weighted with the updated idfs. Base documents
+        # were weighted with the base idfs, so queries against them are
+        # rescaled by idf / base_idf per term.
+        idfs = utils.get_idfs(doc_freqs, num_docs)
+        base_scale = utils.get_reweighting(
+            self.base_doc_freqs, self.base_num_docs, idfs, self.zero_idf_tf
+        )
+
+        tombstones = np.zeros(self.base_num_docs, dtype=bool)
+        tombstones[metadata['tombstones']] = True
+
+        self.delta_doc_dict = metadata['doc_ids']
+        self.delta_mat = utils.weight_counts(counts, idfs)
+        self.tombstones = tombstones
+        self.base_scale = base_scale
+        self.doc_freqs = doc_freqs
+        self.num_docs = num_docs
+
+    def clear_cache(self):
+        """Drop all cached query vectors and results."""
+        for cache in (self.query_cache, self.result_cache):
+            if cache is not None:
+                cache.clear()
+
+    def cache_stats(self):
+        """Hit/miss counters of the query vector and result caches."""
+        return {name: cache.stats() for name, cache in
+                [('query', self.query_cache), ('result', self.result_cache)]
+                if cache is not None}
 
     def get_doc_index(self, doc_id):
         """Convert doc_id --> doc_index"""
-        return self.doc_dict[0][doc_id]
+        if self.delta_mat is not None and doc_id in self.delta_doc_dict:
+            return self.base_num_docs + self.delta_doc_dict.get_index(doc_id)
+        return self.doc_dict.get_index(doc_id)
 
     def get_doc_id(self, doc_index):
         """Convert doc_index --> doc_id"""
-        return self.doc_dict[1][doc_index]
+        if doc_index >= self.base_num_docs:
+            return self.delta_doc_dict.get_id(doc_index - self.base_num_docs)
+        return self.doc_dict.get_id(doc_index)
+
+    def scores(self, spvecs):
+        """Score query vectors against all documents (one row per query)."""
+        if self.delta_mat is None:
+            return utils.sparse_dot(spvecs, self.doc_mat, self.scales)
 
-    def closest_docs(self, query, k=1):
+        base_spvecs = spvecs.copy()
+        base_spvecs.data *= self.base_scale[base_spvecs.indices]
+        base_res = utils.sparse_dot(base_spvecs, self.doc_mat, self.scales)
+        base_res.data[self.tombstones[base_res.indices]] = 0
+        base_res.eliminate_zeros()
+        delta_res = spvecs * self.delta_mat
+        return sp.hstack([base_res, delta_res], format='csr')
+
+    def closest_docs(self, query, k=1, max_terms=None, weight_frac=None):
         """Closest docs by dot product between query and documents
         in tfidf weighted word vector space.
+
+        max_terms and weight_frac override the ranker's query-term pruning
+        budget for this call (see prune_query).
         """
-        spvec = self.text2spvec(query)
-        res = spvec * self.doc_mat
+        budget = self._get_budget(max_terms, weight_frac)
+        if self.result_cache is None:
+            return self._closest_docs(query, k, budget)
+        key = (utils.normalize(query), k, budget)
+        result = self.result_cache.get(key)
+        if result is None:
+            result = self._closest_docs(query, k, budget)
+            self.result_cache.put(key, result)
+        return result
+
+    def _closest_docs(self, query, k=1, budget=(None, None)):
+        """Rank a single query (uncached)."""
+        spvec = self.query_vector(query, budget)
+        res = self.scores(spvec)
 
         if len(res.data) <= k:
             o_sort = np.argsort(-res.data)
@@ -69,15 +224,93 @@ class TfidfDocRanker(object):
         doc_ids = [self.get_doc_id(i) for i in res.indices[o_sort]]
         return doc_ids, doc_scores
 
-    def batch_closest_docs(self, queries, k=1, num_workers=None):
-        """Process a batch of closest_docs requests multithreaded.
+    def batch_closest_docs(self, queries, k=1, num_workers=None,
+                           max_terms=None, weight_frac=None):
+        """Process a batch of closest_docs requests.
+
+        Query vectors are stacked into one sparse matrix per chunk of
+        BATCH_SIZE queries, which is scored with a single sparse product.
+        Chunks are processed multithreaded. Only queries missing from the
+        result cache (if any) are ranked.
         Note: we can use plain threads here as scipy is outside of the GIL.
         """
-        with ThreadPool(num_workers) as threads:
-            closest_docs = partial(self.closest_docs, k=k)
-            results = threads.map(closest_docs, queries)
+        budget = self._get_budget(max_terms, weight_frac)
+        results = [None] * len(queries)
+        if self.result_cache is not None:
+            keys = [(utils.normalize(q), k, budget) for q in queries]
+            results = [self.result_cache.get(key) for key in keys]
+        todo = [i for i, r in enumerate(results) if r is None]
+
+        todo_queries = [queries[i] for i in todo]
+        chunks = [todo_queries[i:i + self.BATCH_SIZE]
+                  for i in range(0, len(todo_queries), self.BATCH_SIZE)]
+        batch_closest_docs = partial(self._batch_closest_docs, k=k,
+                                     budget=budget)
+        if len(chunks) <= 1:
+            ranked = [batch_closest_docs(c) for c in chunks]
+        else:
+            with ThreadPool(num_workers) as threads:
+                ranked = threads.map(batch_closest_docs, chunks)
+
+        ranked = [r for chunk_results in ranked for r in chunk_results]
+        for i, result in zip(todo, ranked):
+            results[i] = result
+            if self.result_cache is not None:
+                self.result_cache.put(keys[i], result)
+        return results
+
+    def _batch_closest_docs(self, queries, k=1, budget=(None, None)):
+        """Score a chunk of queries with one sparse matrix product."""
+        spvecs = sp.vstack([self.query_vector(q, budget) for q in queries],
+                           format='csr')
+        res = self.scores(spvecs)
+        results = []
+        for indices, doc_scores in utils.top_k_per_row(res, k):
+            doc_ids = [self.get_doc_id(i) for i in indices]
+            results.append((doc_ids, doc_scores))
         return results
 
+    def _get_budget(self, max_terms=None, weight_frac=None):
+        """Per-call pruning budget, falling back on the ranker defaults."""
+        return (self.max_terms if max_terms is None else max_terms,
+                self.weight_frac if weight_frac is None else weight_frac)
+
+    def query_vector(self, query, budget=(None, None)):
+        """Query vector, pruned to a (max_terms, weight_frac) budget."""
+        return self.prune_query(self.text2spvec(query), *budget)
+
+    def prune_query(self, spvec, max_terms=None, weight_frac=None):
+        """Drop low-value terms of a query vector before scoring.
+
+        Every query term reads a full postings row, so this trades recall for
+        latency on long queries.
+
+        Args:
+            spvec: 1 x hash_size query vector
+            max_terms: keep only the max_terms highest-idf terms (0 or None
+              for no limit)
+            weight_frac: then keep only the highest-weight terms covering
+              this fraction of the total query weight (None or 1 for all)
+        """
+        indices, data = spvec.indices, spvec.data
+        if max_terms and len(indices) > max_terms:
+            idfs = utils.get_idfs(self.doc_freqs[indices], self.num_docs)
+            keep = np.argsort(-idfs, kind='stable')[:max_terms]
+            indices, data = indices[keep], data[keep]
+        if weight_frac is not None and weight_frac < 1 and len(data) > 0:
+            order = np.argsort(-data, kind='stable')
+            weights = np.cumsum(data[order])
+            n = np.searchsorted(weights, weight_frac * weights[-1]) + 1
+            indices, data = indices[order[:n]], data[order[:n]]
+        if len(indices) == len(spvec.indices):
+            return spvec
+
+        order = np.argsort(indices)
+        return sp.csr_matrix(
+            (data[order], indices[order], np.array([0, len(indices)])),
+            shape=spvec.shape
+        )
+
     def parse(self, query):
         """Parse the query into tokens (either ngrams or tokens)."""
         tokens = self.tokenizer.tokenize(query)
@@ -89,11 +322,24 @@ class TfidfDocRanker(object):
 
         tfidf = log(tf + 1) * log((N - Nt + 0.5) / (Nt + 0.5))
         """
+        query = utils.normalize(query)
+        if self.query_cache is None:
+            return self._text2spvec(query)
+        spvec = self.query_cache.get(query)
+        if spvec is None:
+            spvec = self._text2spvec(query)
+            self.query_cache.put(query, spvec)
+        return spvec
+
+    def _text2spvec(self, query):
+        """Build the query vector (uncached)."""
         # Get hashed ngrams
-        words = self.parse(utils.normalize(query))
-        wids = [utils.hash(w, self.hash_size) for w in words]
+        tokens = self.tokenizer.tokenize(query)
+        wids_unique, wids_counts = utils.hash_ngrams(
+            tokens.words(uncased=True), self.ngrams, self.hash_size
+        )
 
-        if len(wids) == 0:
+        if len(wids_unique) == 0:
             if self.strict:
                 raise RuntimeError('No valid word in: %s' % query)
             else:
@@ -101,17 +347,18 @@ class TfidfDocRanker(object):
                 return sp.csr_matrix((1, self.hash_size))
 
         # Count TF
-        wids_unique, wids_counts = np.unique(wids, return_counts=True)
         tfs = np.log1p(wids_counts)
 
         # Count IDF
-        Ns = self.doc_freqs[wids_unique]
-        idfs = np.log((self.num_docs - Ns + 0.5) / (Ns + 0.5))
-        idfs[idfs < 0] = 0
+        idfs = utils.get_idfs(self.doc_freqs[wids_unique], self.num_docs)
 
         # TF-IDF
         data = np.multiply(tfs, idfs)
 
+        # Zero idf terms score nothing (their postings only keep their tfs)
+        nonzero = data != 0
+        data, wids_unique = data[nonzero], wids_unique[nonzero]
+
         # One row, sparse csr matrix
         indptr = np.array([0, len(wids_unique)])
         spvec = sp.csr_matrix(
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Pre-tokenized document paragraphs, in memory-mapped arrays."""
+
+import os
+import json
+import numpy as np
+
+from .utils import DocDict
+from ..tokenizers.tokenizer import Tokens
+
+# Annotation columns, with the Tokens field they fill.
+COLUMNS = (('word', Tokens.TEXT), ('pos', Tokens.POS),
+           ('lemma', Tokens.LEMMA), ('ner', Tokens.NER))
+
+
+class TokenStore(object):
+    """Tokens of every paragraph (see utils.split_paragraphs) of a document
+    db, keyed by doc id and paragraph index (see pretokenize.py).
+
+    The directory holds flat arrays, memory-mapped on load: per-token char
+    offsets and vocabulary ids of the words and annotations, the paragraph
+    texts, and pointers from docs to paragraphs and from paragraphs to
+    tokens. Nothing is read until accessed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        self.annotators = set(header['annotators'])
+        self.tokenizer = header['tokenizer']
+        self.opts = header['opts']
+        self.arrays = {name: self._load_raw(name, dtype, length)
+                       for name, (dtype, length) in header['arrays'].items()}
+        self.doc_dict = self._load_doc_dict('doc_ids')
+        self.vocabs = {name: self._load_doc_dict('vocab.' + name)
+                       for name in header['columns']}
+        self.vocab_blobs = {name: memoryview(vocab.blob)
+                            for name, vocab in self.vocabs.items()}
+
+    def _load_raw(self, name, dtype, length):
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype,
+                         mode='r', shape=(length,))
+
+    def _load_doc_dict(self, name):
+        return DocDict(*[np.load(os.path.join(self.path, '%s.%s.npy' %
+                                              (name, array)), mmap_mode='r')
+                         for array in DocDict.ARRAYS])
+
+    def _decode(self, name, ids):
+        """Vocabulary strings of an array of ids (vectorized get_id)."""
+        offsets = self.vocabs[name].offsets
+        blob = self.vocab_blobs[name]
+        return [str(blob[start:end], 'utf-8') for start, end in
+                zip(offsets[ids].tolist(), offsets[ids + 1].tolist())]
+
+    def __len__(self):
+        return len(self.doc_dict)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_dict
+
+    def get_tokens(self, doc_id, idx, text=None):
+        """Tokens of paragraph idx of doc_id, or None if it is not stored
+        (or if its stored text differs from text, when given).
+        """
+        if doc_id not in self.doc_dict:
+            return None
+        doc_ptr = self.arrays['doc_ptr']
+        doc_index = self.doc_dict.get_index(doc_id)
+        paragraph = doc_ptr[doc_index] + idx
+        if idx < 0 or paragraph >= doc_ptr[doc_index + 1]:
+            return None
+
+        text_ptr = self.arrays['text_ptr']
+        stored = self.arrays['text'][text_ptr[paragraph]:
+                                     text_ptr[paragraph + 1]]
+        stored = stored.tobytes().decode('utf-8')
+        if text is not None and stored != text:
+            return None
+
+        para_ptr = self.arrays['para_ptr']
+        start, end = para_ptr[paragraph], para_ptr[paragraph + 1]
+        starts = self.arrays['start'][start:end].tolist()
+        ends = self.arrays['end'][start:end].tolist()
+        columns = [[None] * len(starts)] * 6
+        for name, field in COLUMNS:
+            if name in self.vocabs:
+                columns[field] = self._decode(name,
+                                              self.arrays[name][start:end])
+        data = []
+        for i in range(len(starts)):
+            # Whitespace runs up to the next token (like the tokenizers).
+            end_ws = starts[i + 1] if i + 1 < len(starts) else ends[i]
+            data.append((
+                columns[Tokens.TEXT][i],
+                stored[starts[i]:end_ws],
+                (starts[i], ends[i]),
+                columns[Tokens.POS][i],
+                columns[Tokens.LEMMA][i],
+                columns[Tokens.NER][i],
+            ))
+        return Tokens(data, set(self.annotators), dict(self.opts))
+
+
+class TokenStoreWriter(object):
+    """Writes a TokenStore, one document at a time (in any order). Arrays are
+    appended to files as documents are added; only the doc ids and
+    vocabularies are kept in memory until close().
+    """
+    DTYPES = {'doc_ptr': '<i8', 'para_ptr': '<i8', 'text_ptr': '<i8',
+              'text': '|u1', 'start': '<i4', 'end': '<i4', 'word': '<i4',
+              'pos': '<i4', 'lemma': '<i4', 'ner': '<i4'}
+
+    def __init__(self, path, annotators, tokenizer):
+        """
+        Args:
+            path: output directory (must not hold a store already)
+            annotators: annotations stored besides words (pos, lemma, ner)
+            tokenizer: name of the tokenizer (recorded in the header)
+        """
+        if os.path.isfile(os.path.join(path, 'header.json')):
+            raise RuntimeError('%s already exists! Not overwriting.' % path)
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.annotators = sorted(annotators)
+        self.tokenizer = tokenizer
+        self.opts = {}
+        self.columns = ['word'] + [name for name, _ in COLUMNS[1:]
+                                   if name in annotators]
+        self.vocabs = {name: {} for name in self.columns}
+        self.doc_ids = []
+        self.arrays = ['doc_ptr', 'para_ptr', 'text_ptr', 'text', 'start',
+                       'end'] + self.columns
+        self.lengths = {name: 0 for name in self.arrays}
+        self.files = {name: open(os.path.join(path, name + '.bin'), 'wb')
+                      for name in self.arrays}
+        self.num_paragraphs = 0
+        self.num_tokens = 0
+        self.num_bytes = 0
+        self._write('doc_ptr', [0])
+        self._write('para_ptr', [0])
+        self._write('text_ptr', [0])
+
+    def _write(self, name, values):
+        array = np.asarray(values, dtype=self.DTYPES[name])
+        self.files[name].write(array.tobytes())
+        self.lengths[name] += len(array)
+
+    def _encode(self, name, values):
+        vocab = self.vocabs[name]
+        return [vocab.setdefault(value, len(vocab)) for value in values]
+
+    def add(self, doc_id, paragraphs, tokens):
+        """Add a document: its paragraph texts, and the Tokens of each."""
+        if tokens:
+            self.opts = tokens[0].opts
+        for text, paragraph_tokens in zip(paragraphs, tokens):
+            encoded = text.encode('utf-8')
+            self._write('text', np.frombuffer(encoded, dtype=np.uint8))
+            self.num_bytes += len(encoded)
+            self._write('text_ptr', [self.num_bytes])
+
+            offsets = paragraph_tokens.offsets()
+            self._write('start', [start for start, _ in offsets])
+            self._write('end', [end for _, end in offsets])
+            self._write('word', self._encode('word', paragraph_tokens.words()))
+            for name, values in [('pos', paragraph_tokens.pos),
+                                 ('lemma', paragraph_tokens.lemmas),
+                                 ('ner', paragraph_tokens.entities)]:
+                if name in self.vocabs:
+                    values = values() or [None] * len(offsets)
+                    self._write(name, self._encode(
+                        name, ['' if v is None else v for v in values]
+                    ))
+            self.num_tokens += len(offsets)
+            self._write('para_ptr', [self.num_tokens])
+        self.num_paragraphs += len(paragraphs)
+        self._write('doc_ptr', [self.num_paragraphs])
+        self.doc_ids.append(doc_id)
+
+    def close(self):
+        """Save the doc ids, vocabularies and header."""
+        for f in self.files.values():
+            f.close()
+
+        def _save(name, doc_dict):
+            for array, values in doc_dict.arrays().items():
+                np.save(os.path.join(self.path, '%s.%s.npy' % (name, array)),
+                        values)
+
+        _save('doc_ids', DocDict.from_ids(self.doc_ids))
+        for name, vocab in self.vocabs.items():
+            _save('vocab.' + name, DocDict.from_ids(
+                sorted(vocab, key=vocab.__getitem__)
+            ))
+        header = {
+            'annotators': self.annotators,
+            'tokenizer': self.tokenizer,
+            'opts': self.opts,
+            'columns': self.columns,
+            'arrays': {name: [self.DTYPES[name], self.lengths[name]]
+                       for name in self.arrays},
+        }
+        with open(os.path.join(self.path, 'header.json'), 'w') as f:
+            json.dump(header, f)
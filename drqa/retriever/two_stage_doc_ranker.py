@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Rank documents with TF-IDF scores, in two stages: cheap candidate
+generation, then exact rescoring of the candidates.
+"""
+
+import logging
+import threading
+import numpy as np
+import scipy.sparse as sp
+
+from . import utils
+from .tfidf_doc_ranker import TfidfDocRanker
+
+logger = logging.getLogger(__name__)
+
+
+class TwoStageDocRanker(TfidfDocRanker):
+    """Loads a pre-weighted inverted index of token/document terms, plus a
+    candidate index holding only the top postings of every hash bucket
+    (see build_tfidf.py --candidate-top-n).
+
+    Stage one scores queries against the candidate index, whose rows are
+    short, and keeps the best num_candidates documents. Stage two computes
+    their exact tf-idf scores with binary searches into the full postings.
+
+    Documents missing from the candidates can only have been missed by the
+    weights left out of the candidate index, which are bounded per bucket.
+    When the k-th exact score beats that bound the top-k is provably the
+    exhaustive one; otherwise the query is counted as unsafe (and rescored
+    exhaustively if exact is set).
+    """
+
+    def __init__(self, tfidf_path=None, strict=True, num_candidates=200,
+                 candidate_top_n=1000, exact=False, check=False,
+                 cache_size=0, max_terms=None, weight_frac=None):
+        """
+        Args:
+            tfidf_path: path to saved model file
+            strict: fail on empty queries or continue (and return empty result)
+            num_candidates: number of documents rescored in stage two
+            candidate_top_n: postings kept per bucket when the model has no
+              candidate index and it is built at load time
+            exact: rescore unsafe queries exhaustively
+            check: also score every query exhaustively and log any difference
+              in the ranking (test mode)
+            cache_size: size of the query vector and result LRU caches
+            max_terms, weight_frac: default query-term pruning budget
+        """
+        super(TwoStageDocRanker, self).__init__(
+            tfidf_path, strict, cache_size=cache_size, max_terms=max_terms,
+            weight_frac=weight_frac
+        )
+        self.num_candidates = num_candidates
+        self.exact = exact
+        self.check = check
+
+        # Exact rescoring binary searches the postings, so they must be sorted.
+        if not self.doc_mat.has_sorted_indices:
+            logger.info('Sorting postings...')
+            self.doc_mat = self.doc_mat.sorted_indices()
+        if 'candidate_data' in self.metadata:
+            self.cand_mat = sp.csr_matrix(
+                (self.metadata['candidate_data'],
+                 self.metadata['candidate_indices'],
+                 self.metadata['candidate_indptr']),
+                shape=self.doc_mat.shape, copy=False
+            )
+            self.cand_cutoffs = self.metadata['candidate_cutoffs']
+        else:
+            logger.info('Building candidate index (rebuild with '
+                        '--candidate-top-n to skip this)...')
+            self.cand_mat, self.cand_cutoffs = utils.get_candidate_index(
+                self.doc_mat, candidate_top_n
+            )
+
+        # Postings read in stage one vs. total postings of the query terms,
+        # queries whose top-k is not proven exact, and number of differences
+        # found in test mode. Updated from batch threads.
+        self.stats = {'queries': 0, 'read': 0, 'total': 0, 'unsafe': 0,
+                      'diffs': 0}
+        self.stats_lock = threading.Lock()
+
+    def load_delta(self, delta_path):
+        """Delta segments are not supported (the candidate index is static)."""
+        if delta_path:
+            raise RuntimeError('TwoStageDocRanker does not support '
+                               'delta segments, compact them first')
+        super(TwoStageDocRanker, self).load_delta(delta_path)
+
+    def _closest_docs(self, query, k=1, budget=(None, None)):
+        """Rank a single query (uncached)."""
+        return self._batch_closest_docs([query], k, budget)[0]
+
+    def _batch_closest_docs(self, queries, k=1, budget=(None, None)):
+        """Generate candidates for a chunk of queries with one sparse product
+        on the candidate index, then rescore them query by query.
+        """
+        spvecs = sp.vstack([self.query_vector(q, budget) for q in queries],
+                           format='csr')
+        cand_res = utils.sparse_dot(spvecs, self.cand_mat, self.scales)
+        stage_one = utils.top_k_per_row(cand_res, self.num_candidates + 1)
+
+        results = []
+        for i, (candidates, cand_scores) in enumerate(stage_one):
+            spvec = spvecs[i]
+            doc_indices, doc_scores, safe = self.rescore(
+                spvec.indices, spvec.data, candidates, cand_scores, k
+            )
+            if not safe and self.exact:
+                doc_indices, doc_scores = self.exhaustive(spvec, k)
+            doc_ids = [self.get_doc_id(j) for j in doc_indices]
+            if self.check:
+                self._check(spvec, k, doc_ids, doc_scores)
+            results.append((doc_ids, doc_scores))
+        return results
+
+    def rescore(self, terms, weights, candidates, cand_scores, k):
+        """Compute exact scores of the stage one candidates.
+
+        Args:
+            terms, weights: query vector
+            candidates, cand_scores: the best num_candidates + 1 stage one
+              documents and scores, sorted by decreasing score
+
+        Returns:
+            doc_indices, doc_scores, safe: the top-k sorted by decreasing
+            score, and whether it is provably the exhaustive top-k.
+        """
+        # Anything not rescored can score at most its stage one score plus
+        # the weights left out of the candidate index.
+        cutoffs = self.cand_cutoffs[terms].astype(np.float64)
+        if self.scales is not None:
+            cutoffs *= self.scales[terms]
+        bound = np.dot(weights, cutoffs)
+        if len(candidates) > self.num_candidates:
+            bound += cand_scores[-1]
+            candidates = candidates[:-1]
+
+        scores = np.zeros(len(candidates))
+        for term, weight in zip(terms, weights):
+            values = utils.get_row_values(self.doc_mat, term, candidates)
+            if self.scales is not None:
+                values = values * self.scales[term]
+            scores += weight * values
+
+        if len(scores) <= k:
+            o_sort = np.argsort(-scores)
+        else:
+            o = np.argpartition(-scores, k)[0:k]
+            o_sort = o[np.argsort(-scores[o])]
+        safe = (bound == 0 or
+                (len(o_sort) == k and scores[o_sort[-1]] >= bound))
+
+        indptr = self.doc_mat.indptr
+        cand_indptr = self.cand_mat.indptr
+        with self.stats_lock:
+            self.stats['queries'] += 1
+            self.stats['read'] += int(sum(cand_indptr[terms + 1] -
+                                          cand_indptr[terms]))
+            self.stats['total'] += int(sum(indptr[terms + 1] - indptr[terms]))
+            self.stats['unsafe'] += int(not safe)
+        return candidates[o_sort], scores[o_sort], safe
+
+    def exhaustive(self, spvec, k):
+        """Exhaustive top-k of a query vector."""
+        res = self.scores(spvec)
+        indices, doc_scores = utils.top_k_per_row(res, k)[0]
+        return indices, doc_scores
+
+    def _check(self, spvec, k, doc_ids, doc_scores):
+        """Compare a ranking with the exhaustive one."""
+        exact_indices, exact_scores = self.exhaustive(spvec, k)
+        if (len(exact_scores) != len(doc_scores) or
+                not np.allclose(exact_scores, doc_scores)):
+            exact_ids = [self.get_doc_id(i) for i in exact_indices]
+            logger.warning('Ranking differs from exhaustive:\n'
+                           'exhaustive: %s %s\ntwo-stage: %s %s' %
+                           (exact_ids, exact_scores, doc_ids, doc_scores))
+            with self.stats_lock:
+                self.stats['diffs'] += 1
@@ -6,34 +6,733 @@
 # LICENSE file in the root directory of this source tree.
 """Various retriever utilities."""
 
+import os
+import json
 import regex
+import threading
 import unicodedata
+import zlib
 import numpy as np
 import scipy.sparse as sp
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from multiprocessing.util import Finalize
 from sklearn.utils import murmurhash3_32
 
+# zstandard is optional (for zstd compressed document dbs)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 # ------------------------------------------------------------------------------
 # Sparse matrix saving/loading helpers.
 # ------------------------------------------------------------------------------
 
 
+def get_index_dtype(matrix):
+    """Smallest index dtype (int32 or int64) for a matrix's indices/indptr."""
+    if max(matrix.nnz, max(matrix.shape)) < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
 def save_sparse_csr(filename, matrix, metadata=None):
-    data = {
+    """Save a csr matrix and its metadata in a .npz file, without pickling.
+
+    Array-valued metadata (and DocDicts) are stored as arrays of their own,
+    and the scalar metadata in a json header.
+    """
+    idx_dtype = get_index_dtype(matrix)
+    arrays, header = pack_metadata(metadata)
+    header['shape'] = list(matrix.shape)
+    arrays.update({
         'data': matrix.data,
-        'indices': matrix.indices,
-        'indptr': matrix.indptr,
-        'shape': matrix.shape,
-        'metadata': metadata,
-    }
-    np.savez(filename, **data)
+        'indices': matrix.indices.astype(idx_dtype, copy=False),
+        'indptr': matrix.indptr.astype(idx_dtype, copy=False),
+        'header': np.array(json.dumps(header)),
+    })
+    np.savez(filename, **arrays)
 
 
 def load_sparse_csr(filename):
+    if str(filename).startswith(SHM_PREFIX):
+        return attach_sparse_csr_shm(str(filename)[len(SHM_PREFIX):])
+    if os.path.isdir(filename):
+        return load_sparse_csr_mmap(filename)
     loader = np.load(filename)
+    if 'header' not in loader:
+        return load_sparse_csr_legacy(filename)
+    header = json.loads(loader['header'].item())
+    matrix = sp.csr_matrix((loader['data'], loader['indices'],
+                            loader['indptr']), shape=tuple(header['shape']))
+    return matrix, unpack_metadata(header, lambda key: loader[key])
+
+
+def load_sparse_csr_legacy(filename):
+    """Load a .npz file with pickled metadata (saved by older versions)."""
+    loader = np.load(filename, allow_pickle=True)
     matrix = sp.csr_matrix((loader['data'], loader['indices'],
                             loader['indptr']), shape=loader['shape'])
-    return matrix, loader['metadata'].item(0) if 'metadata' in loader else None
+    metadata = loader['metadata'].item(0) if 'metadata' in loader else None
+    return matrix, convert_legacy_metadata(metadata)
+
+
+def save_sparse_csr_mmap(dirname, matrix, metadata=None):
+    """Save a csr matrix as raw arrays that can be memory-mapped on load.
+
+    The directory holds one .npy file per array (the matrix data, indices and
+    indptr plus any array-valued metadata or DocDict) and a small json header
+    with the shape and the scalar metadata.
+    """
+    os.makedirs(dirname, exist_ok=True)
+
+    # Use one index dtype for indices and indptr, so scipy never has to
+    # upcast (and copy) the mapped arrays.
+    idx_dtype = get_index_dtype(matrix)
+    arrays, header = pack_metadata(metadata)
+    header['shape'] = list(matrix.shape)
+    arrays.update({
+        'data': matrix.data,
+        'indices': matrix.indices.astype(idx_dtype, copy=False),
+        'indptr': matrix.indptr.astype(idx_dtype, copy=False),
+    })
+    for name, array in arrays.items():
+        np.save(os.path.join(dirname, name + '.npy'), array)
+    with open(os.path.join(dirname, 'header.json'), 'w') as f:
+        json.dump(header, f)
+
+
+def load_sparse_csr_mmap(dirname):
+    """Load a csr matrix saved by save_sparse_csr_mmap without reading it.
+
+    The arrays are opened with np.memmap, so pages are only read on access
+    and are shared through the page cache by every process using the index.
+    """
+    with open(os.path.join(dirname, 'header.json')) as f:
+        header = json.load(f)
+
+    def _load(name):
+        return np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+
+    matrix = sp.csr_matrix(
+        (_load('data'), _load('indices'), _load('indptr')),
+        shape=tuple(header['shape']), copy=False
+    )
+    return matrix, unpack_metadata(header, _load)
+
+
+# Paths of the form shm://<name> point to a published shared memory segment.
+SHM_PREFIX = 'shm://'
+SHM_ALIGN = 64
+
+# Segments attached by this process. They stay mapped as long as the process
+# lives, since the arrays loaded from them are views of their buffers.
+SHM_SEGMENTS = {}
+
+
+def _shared_memory():
+    """multiprocessing.shared_memory, imported on use (python >= 3.8)."""
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError('Shared memory models require python >= 3.8')
+    return shared_memory
+
+
+def _shm_align(offset):
+    return -(-offset // SHM_ALIGN) * SHM_ALIGN
+
+
+def publish_sparse_csr_shm(matrix, metadata=None, name=None):
+    """Copy a csr matrix and its metadata into a new named shared memory
+    segment, so that other processes can attach to it without a copy.
+
+    The segment holds the length of a json header, the header (shape, scalar
+    metadata and the offset, dtype and shape of every array) and the arrays,
+    aligned on 64 bytes. Returns the SharedMemory: the creating process owns
+    the segment, which is unlinked when it calls unlink() or exits.
+    """
+    idx_dtype = get_index_dtype(matrix)
+    arrays, header = pack_metadata(metadata)
+    header['shape'] = list(matrix.shape)
+    arrays.update({
+        'data': matrix.data,
+        'indices': matrix.indices.astype(idx_dtype, copy=False),
+        'indptr': matrix.indptr.astype(idx_dtype, copy=False),
+    })
+    layout = {}
+    size = 0
+    for key, array in arrays.items():
+        layout[key] = [size, array.dtype.str, list(array.shape)]
+        size = _shm_align(size + array.nbytes)
+    header['layout'] = layout
+    encoded = json.dumps(header).encode('utf-8')
+    start = _shm_align(8 + len(encoded))
+
+    shm = _shared_memory().SharedMemory(name=name, create=True,
+                                        size=max(start + size, 1))
+    np.ndarray(1, np.uint64, buffer=shm.buf)[0] = len(encoded)
+    shm.buf[8:8 + len(encoded)] = encoded
+    for key, array in arrays.items():
+        offset, dtype, shape = layout[key]
+        view = np.ndarray(shape, dtype, buffer=shm.buf, offset=start + offset)
+        view[...] = array
+    SHM_SEGMENTS[shm.name] = shm
+    return shm
+
+
+def attach_sparse_csr_shm(name):
+    """Load a csr matrix published by publish_sparse_csr_shm (zero copy).
+
+    Arrays are read-only views of the segment. Attaching does not make this
+    process an owner: the segment is not unlinked when it exits.
+    """
+    if name not in SHM_SEGMENTS:
+        SHM_SEGMENTS[name] = _open_shm(name)
+    buf = SHM_SEGMENTS[name].buf
+    length = int(np.ndarray(1, np.uint64, buffer=buf)[0])
+    header = json.loads(bytes(buf[8:8 + length]).decode('utf-8'))
+    start = _shm_align(8 + length)
+
+    def _load(key):
+        offset, dtype, shape = header['layout'][key]
+        array = np.ndarray(shape, dtype, buffer=buf, offset=start + offset)
+        array.flags.writeable = False
+        return array
+
+    matrix = sp.csr_matrix(
+        (_load('data'), _load('indices'), _load('indptr')),
+        shape=tuple(header['shape']), copy=False
+    )
+    return matrix, unpack_metadata(header, _load)
+
+
+def _open_shm(name):
+    """Open an existing segment without registering it for cleanup."""
+    shared_memory = _shared_memory()
+    from multiprocessing import resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Before python 3.13, attached segments are registered with the resource
+    # tracker too, which unlinks them when the attaching process exits.
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def pack_metadata(metadata):
+    """Split metadata into arrays to save and a json-serializable header."""
+    arrays = {}
+    header = {'arrays': [], 'doc_dicts': [], 'metadata': {}}
+    for key, value in (metadata or {}).items():
+        if isinstance(value, np.ndarray):
+            arrays[key] = value
+            header['arrays'].append(key)
+        elif isinstance(value, DocDict):
+            for name, array in value.arrays().items():
+                arrays['%s.%s' % (key, name)] = array
+            header['doc_dicts'].append(key)
+        elif isinstance(value, np.generic):
+            header['metadata'][key] = value.item()
+        elif isinstance(value, (str, int, float, bool)) or value is None:
+            header['metadata'][key] = value
+        else:
+            raise TypeError('Can not save metadata %s of type %s' %
+                            (key, type(value)))
+    return arrays, header
+
+
+def unpack_metadata(header, load_fn):
+    """Rebuild metadata from a header, loading arrays with load_fn(name)."""
+    metadata = dict(header['metadata'])
+    for key in header['arrays']:
+        metadata[key] = load_fn(key)
+    for key in header.get('doc_dicts', []):
+        metadata[key] = DocDict(*[load_fn('%s.%s' % (key, name))
+                                  for name in DocDict.ARRAYS])
+    return metadata
+
+
+def convert_legacy_metadata(metadata):
+    """Replace the (dict, list) doc_dict of older models with a DocDict."""
+    if metadata and isinstance(metadata.get('doc_dict'), tuple):
+        metadata['doc_dict'] = DocDict.from_ids(metadata['doc_dict'][1])
+    if metadata and isinstance(metadata.get('doc_ids'), list):
+        metadata['doc_ids'] = DocDict.from_ids(metadata['doc_ids'])
+    return metadata
+
+
+# ------------------------------------------------------------------------------
+# Doc id <--> doc index mapping.
+# ------------------------------------------------------------------------------
+
+
+class DocDict(object):
+    """Maps doc ids to doc indices and back, using flat arrays only.
+
+    The utf-8 encoded ids are concatenated in index order (blob) with their
+    start offsets, so get_id is a slice. order holds the indices sorted by
+    id, for a binary search in get_index. Nothing has to be unpickled or
+    hashed on load, and the arrays can be memory-mapped.
+    """
+    ARRAYS = ('blob', 'offsets', 'order')
+
+    def __init__(self, blob, offsets, order):
+        # Plain ndarray views of memory-mapped arrays: np.memmap indexing
+        # goes through python code, which dominates the binary search.
+        self.blob, self.offsets, self.order = [
+            np.asarray(array).view(np.ndarray)
+            for array in (blob, offsets, order)
+        ]
+
+    @classmethod
+    def from_ids(cls, doc_ids):
+        """Build from a list of doc ids, in doc index order."""
+        encoded = [doc_id.encode('utf-8') for doc_id in doc_ids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        idx_dtype = (np.int32 if len(encoded) < np.iinfo(np.int32).max
+                     else np.int64)
+        order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__),
+                         dtype=idx_dtype)
+        return cls(blob, offsets, order)
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_id(i)
+
+    def __contains__(self, doc_id):
+        return self._search(doc_id) is not None
+
+    def _key(self, doc_index):
+        return self.blob[self.offsets[doc_index]:
+                         self.offsets[doc_index + 1]].tobytes()
+
+    def _search(self, doc_id):
+        key = doc_id.encode('utf-8')
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self._key(self.order[lo]) == key:
+            return int(self.order[lo])
+        return None
+
+    def get_index(self, doc_id):
+        """Convert doc_id --> doc_index (raises KeyError if unknown)."""
+        doc_index = self._search(doc_id)
+        if doc_index is None:
+            raise KeyError(doc_id)
+        return doc_index
+
+    def get_id(self, doc_index):
+        """Convert doc_index --> doc_id"""
+        return self._key(doc_index).decode('utf-8')
+
+
+# ------------------------------------------------------------------------------
+# Sparse matrix scoring helpers.
+# ------------------------------------------------------------------------------
+
+
+def top_k_per_row(matrix, k):
+    """Find the k largest entries of every row of a csr matrix.
+
+    All rows are handled at once: entries are sorted by (row, -value) and the
+    first k of every row's indptr segment are kept.
+
+    Returns:
+        A list with one (column indices, values) tuple per row, sorted by
+        decreasing value.
+    """
+    counts = np.diff(matrix.indptr)
+    rows = np.repeat(np.arange(matrix.shape[0]), counts)
+    order = np.lexsort((-matrix.data, rows))
+    ranks = np.arange(len(order)) - np.repeat(matrix.indptr[:-1], counts)
+    keep = order[ranks < k]
+    splits = np.cumsum(np.minimum(counts, k))[:-1]
+    return list(zip(np.split(matrix.indices[keep], splits),
+                    np.split(matrix.data[keep], splits)))
+
+
+def get_idfs(doc_freqs, num_docs):
+    """idf = log((N - Nt + 0.5) / (Nt + 0.5)), clipped at 0 (Nt is clipped
+    to [0, N] first).
+    """
+    doc_freqs = np.clip(doc_freqs, 0, num_docs)
+    idfs = np.log((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+    idfs[idfs < 0] = 0
+    return idfs
+
+
+def get_weight_idfs(doc_freqs, num_docs):
+    """idfs the weights of a model are stored with: zero idfs are replaced
+    by 1, so zero idf buckets keep log(tf + 1). Queries give these buckets
+    no weight, and a delta that makes their idf positive can still reweight
+    them (models with metadata['zero_idf_tf']).
+    """
+    idfs = get_idfs(doc_freqs, num_docs)
+    idfs[idfs == 0] = 1
+    return idfs
+
+
+def get_reweighting(base_doc_freqs, base_num_docs, idfs, zero_idf_tf):
+    """Per bucket factors turning the stored weights of a base model into
+    weights with the given (updated) idfs.
+
+    Models without zero_idf_tf stored zero weights in their zero idf
+    buckets, which can not be reweighted: they are rejected if any of these
+    buckets gets a positive idf.
+    """
+    if zero_idf_tf:
+        return idfs / get_weight_idfs(base_doc_freqs, base_num_docs)
+    base_idfs = get_idfs(base_doc_freqs, base_num_docs)
+    if np.any((base_idfs == 0) & (idfs > 0)):
+        raise RuntimeError('Zero idf buckets of the model get a positive '
+                           'idf, but the model did not keep their tfs: '
+                           'rebuild it with build_tfidf.py')
+    factors = np.zeros(len(idfs))
+    np.divide(idfs, base_idfs, out=factors, where=base_idfs > 0)
+    return factors
+
+
+def weight_counts(counts, idfs):
+    """tf-idf weights log(tf + 1) * idf of a csr count matrix (one row per
+    bucket). Entries with a zero idf are kept (with a zero weight), so the
+    matrix still records which docs have every bucket.
+    """
+    counts = counts.tocsr()
+    counts.sum_duplicates()
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    return sp.csr_matrix(
+        (np.log1p(counts.data) * idfs[rows], counts.indices, counts.indptr),
+        shape=counts.shape
+    )
+
+
+def quantize(matrix, dtype):
+    """Store the (non-negative) weights of a csr matrix with lower precision.
+
+    Args:
+        matrix: csr matrix of float weights
+        dtype: 'float64', 'float32', or 'uint8' for 8-bit weights with a
+          per-row scale (value = uint8 * scales[row]). scipy.sparse does not
+          support float16 matrices.
+
+    Returns:
+        The converted matrix and the per-row scales (None unless uint8).
+    """
+    if dtype != 'uint8':
+        return matrix.astype(dtype), None
+    counts = np.diff(matrix.indptr)
+    scales = (get_max_weights(matrix) / 255).astype(np.float32)
+    row_scales = np.repeat(scales, counts)
+    # Keep every posting: tiny weights round up to the smallest step.
+    data = np.zeros(len(matrix.data), dtype=np.uint8)
+    nonzero = row_scales > 0
+    data[nonzero] = np.clip(
+        np.rint(matrix.data[nonzero] / row_scales[nonzero]), 1, 255
+    )
+    quantized = sp.csr_matrix((data, matrix.indices, matrix.indptr),
+                              shape=matrix.shape)
+    return quantized, scales
+
+
+def get_rows(matrix, rows, scales=None):
+    """Gather rows of a csr matrix into a new float32 csr matrix.
+
+    Only the postings of the given rows are read. If scales is given, row i
+    is multiplied by scales[i] (dequantization).
+    """
+    starts = matrix.indptr[rows]
+    counts = matrix.indptr[rows + 1] - starts
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    pos = np.repeat(starts - indptr[:-1], counts) + np.arange(indptr[-1])
+    data = matrix.data[pos].astype(np.float32)
+    if scales is not None:
+        data *= np.repeat(scales[rows], counts)
+    return sp.csr_matrix((data, matrix.indices[pos], indptr),
+                         shape=(len(rows), matrix.shape[1]))
+
+
+def sparse_dot(spvecs, matrix, scales=None):
+    """Compute spvecs * matrix for any weight precision of matrix.
+
+    float32/float64 matrices are multiplied directly (queries are cast to
+    the matrix dtype so it is never upcast). For quantized matrices only the
+    rows of the query terms are gathered, converted to float32 and
+    dequantized with scales first.
+    """
+    if matrix.dtype in (np.float32, np.float64) and scales is None:
+        return spvecs.astype(matrix.dtype) * matrix
+    terms = np.unique(spvecs.indices)
+    spvecs = spvecs.tocsc()[:, terms].tocsr().astype(np.float32)
+    return spvecs * get_rows(matrix, terms, scales)
+
+
+def get_row_values(matrix, row, cols):
+    """Look up matrix[row, cols] in a csr matrix with sorted indices.
+
+    Uses a binary search over the row's indices, so only O(len(cols) * log
+    nnz(row)) entries are touched. Missing entries are returned as 0.
+    """
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    values = np.zeros(len(cols), dtype=matrix.dtype)
+    if end == start:
+        return values
+    indices = matrix.indices[start:end]
+    pos = np.minimum(np.searchsorted(indices, cols), end - start - 1)
+    found = indices[pos] == cols
+    values[found] = matrix.data[start + pos[found]]
+    return values
+
+
+def get_max_weights(matrix):
+    """Return the largest value of every row of a csr matrix (0 if empty)."""
+    max_weights = np.zeros(matrix.shape[0], dtype=matrix.dtype)
+    nonempty = np.diff(matrix.indptr) > 0
+    if nonempty.any():
+        max_weights[nonempty] = np.maximum.reduceat(
+            matrix.data, matrix.indptr[:-1][nonempty]
+        )
+    return max_weights
+
+
+def get_impact_order(matrix):
+    """Return positions into matrix.data, ordered by row and then by
+    decreasing value, i.e. every row's postings in impact order.
+    """
+    counts = np.diff(matrix.indptr)
+    rows = np.repeat(np.arange(matrix.shape[0]), counts)
+    order = np.lexsort((-matrix.data, rows))
+    return order.astype(matrix.indptr.dtype)
+
+
+def prune_rows(matrix, top_n=None, threshold=None, scales=None):
+    """Keep the top_n largest entries of every row of a csr matrix, and/or
+    the entries of at least threshold. Given per-row scales (e.g. of a uint8
+    matrix, see quantize), the threshold applies to the scaled entries.
+    """
+    keep = np.ones(len(matrix.data), dtype=bool)
+    counts = np.diff(matrix.indptr)
+    rows = np.repeat(np.arange(matrix.shape[0]), counts)
+    if top_n is not None:
+        order = get_impact_order(matrix)
+        ranks = np.arange(len(order)) - np.repeat(matrix.indptr[:-1], counts)
+        keep[order[ranks >= top_n]] = False
+    if threshold is not None:
+        weights = matrix.data
+        if scales is not None:
+            weights = weights * scales[rows]
+        keep &= weights >= threshold
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=matrix.indptr.dtype)
+    np.cumsum(np.bincount(rows[keep], minlength=matrix.shape[0]),
+              out=indptr[1:])
+    return sp.csr_matrix(
+        (matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape
+    )
+
+
+def get_candidate_index(matrix, top_n):
+    """Build a candidate generation index holding the top_n postings of
+    every row (champion lists).
+
+    Returns:
+        The pruned matrix, and the largest weight left out of every row (0
+        if none), which bounds what the missing postings can add to a score.
+    """
+    counts = np.diff(matrix.indptr)
+    long_rows = np.flatnonzero(counts > top_n)
+    cutoffs = np.zeros(matrix.shape[0], dtype=matrix.dtype)
+    if len(long_rows) > 0:
+        order = get_impact_order(matrix)
+        cutoffs[long_rows] = matrix.data[
+            order[matrix.indptr[long_rows] + top_n]
+        ]
+    return prune_rows(matrix, top_n=top_n), cutoffs
+
+
+def get_candidate_metadata(matrix, top_n):
+    """Candidate index of a model as metadata arrays (see
+    TwoStageDocRanker).
+    """
+    cand_mat, cutoffs = get_candidate_index(matrix, top_n)
+    idx_dtype = get_index_dtype(cand_mat)
+    return {
+        'candidate_top_n': top_n,
+        'candidate_data': cand_mat.data,
+        'candidate_indices': cand_mat.indices.astype(idx_dtype, copy=False),
+        'candidate_indptr': cand_mat.indptr.astype(idx_dtype, copy=False),
+        'candidate_cutoffs': cutoffs,
+    }
+
+
+# ------------------------------------------------------------------------------
+# Caching.
+# ------------------------------------------------------------------------------
+
+
+class LRUCache(object):
+    """Bounded, thread-safe mapping evicting the least recently used entry
+    first. Counts hits and misses.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the value cached for key, or None."""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+# ------------------------------------------------------------------------------
+# Process memory (for benchmarks).
+# ------------------------------------------------------------------------------
+
+
+def rss_mb(field='VmRSS'):
+    """Resident set size of this process in MB, current (VmRSS) or peak
+    (VmHWM). None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset the peak RSS (VmHWM) of this process to its current RSS.
+    Returns False if the kernel does not support it.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# ------------------------------------------------------------------------------
+# Document text compression.
+# ------------------------------------------------------------------------------
+
+
+class TextCodec(object):
+    """Compresses document texts for storage: 'none' (plain str), 'zlib', or
+    'zstd' (optionally with a dictionary trained on sample documents, which
+    compresses short texts much better).
+
+    Codec objects are thread-safe: zstd (de)compressors are per thread.
+    """
+    CODECS = ('none', 'zlib', 'zstd')
+
+    def __init__(self, name='none', level=None, dictionary=None):
+        if name not in self.CODECS:
+            raise RuntimeError('Invalid text codec: %s' % name)
+        if name == 'zstd' and zstandard is None:
+            raise RuntimeError('zstd compression requires the zstandard '
+                               'package (pip install zstandard, or '
+                               'pip install -e .[zstd])')
+        self.name = name
+        self.level = level
+        self.dictionary = dictionary
+        self.local = threading.local()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    @staticmethod
+    def train_dictionary(texts, size):
+        """Train a zstd dictionary of size bytes on sample texts."""
+        if zstandard is None:
+            raise RuntimeError('zstd compression requires the zstandard '
+                               'package (pip install zstandard, or '
+                               'pip install -e .[zstd])')
+        samples = [text.encode('utf-8') for text in texts]
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+    def _zstd(self):
+        if not hasattr(self.local, 'compressor'):
+            kwargs = {}
+            if self.dictionary:
+                kwargs['dict_data'] = zstandard.ZstdCompressionDict(
+                    self.dictionary
+                )
+            self.local.compressor = zstandard.ZstdCompressor(
+                level=self.level or 3, **kwargs
+            )
+            self.local.decompressor = zstandard.ZstdDecompressor(**kwargs)
+        return self.local.compressor, self.local.decompressor
+
+    def compress(self, text):
+        if self.name == 'zlib':
+            level = -1 if self.level is None else self.level
+            return zlib.compress(text.encode('utf-8'), level)
+        if self.name == 'zstd':
+            return self._zstd()[0].compress(text.encode('utf-8'))
+        return text
+
+    def decompress(self, data):
+        if data is None or self.name == 'none':
+            return data
+        if self.name == 'zlib':
+            return zlib.decompress(data).decode('utf-8')
+        return self._zstd()[1].decompress(data).decode('utf-8')
 
 
 # ------------------------------------------------------------------------------
@@ -46,6 +745,48 @@ def hash(token, num_buckets):
     return murmurhash3_32(token, positive=True) % num_buckets
 
 
+def hash_ngrams(words, n, num_buckets):
+    """Hash and count all ngrams of up to n words, skipping the ones with a
+    word that passes filter_word.
+
+    Gives the same buckets as hashing tokens.ngrams(n, uncased=True,
+    filter_fn=filter_ngram) with words = tokens.words(uncased=True), but the
+    filter runs once per distinct word (cached), valid spans are found with
+    array ops on the filter flags, and each distinct ngram is hashed once.
+
+    Returns:
+        buckets, counts: sorted unique bucket ids and their ngram counts.
+    """
+    if len(words) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # An ngram of length l starting at s is valid iff no filtered word falls
+    # in words[s:s + l], i.e. the running count of filtered words is equal
+    # at both ends of the span.
+    filtered = np.fromiter((_filter_word_cached(w) for w in words),
+                           dtype=bool, count=len(words))
+    num_filtered = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum(filtered, out=num_filtered[1:])
+    ngrams = Counter()
+    for length in range(1, min(n, len(words)) + 1):
+        starts = np.flatnonzero(num_filtered[length:] ==
+                                num_filtered[:-length]).tolist()
+        if length == 1:
+            ngrams.update(words[s] for s in starts)
+        else:
+            ngrams.update(' '.join(words[s:s + length]) for s in starts)
+
+    hashes = np.fromiter((murmurhash3_32(gram, positive=True)
+                          for gram in ngrams),
+                         dtype=np.int64, count=len(ngrams))
+    buckets, inverse = np.unique(hashes % num_buckets, return_inverse=True)
+    counts = np.bincount(
+        inverse, weights=np.fromiter(ngrams.values(), dtype=np.int64,
+                                     count=len(ngrams))
+    ).astype(np.int64)
+    return buckets, counts
+
+
 # ------------------------------------------------------------------------------
 # Text cleaning.
 # ------------------------------------------------------------------------------
@@ -77,6 +818,12 @@ def normalize(text):
     return unicodedata.normalize('NFD', text)
 
 
+def split_paragraphs(text):
+    """Split a document into its (stripped, non-empty) paragraphs."""
+    paragraphs = (split.strip() for split in regex.split(r'\n+', text))
+    return [paragraph for paragraph in paragraphs if paragraph]
+
+
 def filter_word(text):
     """Take out english stopwords, punctuation, and compound endings."""
     text = normalize(text)
@@ -87,6 +834,11 @@ def filter_word(text):
     return False
 
 
+@lru_cache(maxsize=2 ** 18)
+def _filter_word_cached(text):
+    return filter_word(text)
+
+
 def filter_ngram(gram, mode='any'):
     """Decide whether to keep or discard an n-gram.
 
@@ -106,3 +858,71 @@ def filter_ngram(gram, mode='any'):
         return filtered[0] or filtered[-1]
     else:
         raise ValueError('Invalid mode: %s' % mode)
+
+
+# ------------------------------------------------------------------------------
+# Answer matching (retriever evaluation).
+# ------------------------------------------------------------------------------
+
+
+def regex_match(text, pattern):
+    """Test if a regex pattern is contained within a text."""
+    try:
+        pattern = regex.compile(
+            pattern,
+            flags=regex.IGNORECASE + regex.UNICODE + regex.MULTILINE,
+        )
+    except BaseException:
+        return False
+    return pattern.search(text) is not None
+
+
+def has_answer(answer, text, tokenizer, match):
+    """Check if a document text contains an answer.
+
+    If `match` is string, token matching is done between the text and answer
+    (a list of possible strings), with the given tokenizer.
+    If `match` is regex, we search the whole text with the regex answer[0].
+    """
+    text = normalize(text)
+    if match == 'string':
+        text = tokenizer.tokenize(text).words(uncased=True)
+        for single_answer in answer:
+            single_answer = normalize(single_answer)
+            single_answer = tokenizer.tokenize(single_answer)
+            single_answer = single_answer.words(uncased=True)
+            for i in range(0, len(text) - len(single_answer) + 1):
+                if single_answer == text[i: i + len(single_answer)]:
+                    return True
+    elif match == 'regex':
+        single_answer = normalize(answer[0])
+        if regex_match(text, single_answer):
+            return True
+    return False
+
+
+# Tokenizer and doc db of an answer matching worker process (see
+# init_answer_match).
+MATCH_TOK = None
+MATCH_DB = None
+
+
+def init_answer_match(tokenizer_class, tokenizer_opts, db_class, db_opts):
+    """Process pool initializer for get_answer_score."""
+    global MATCH_TOK, MATCH_DB
+    MATCH_TOK = tokenizer_class(**tokenizer_opts)
+    Finalize(MATCH_TOK, MATCH_TOK.shutdown, exitpriority=100)
+    MATCH_DB = db_class(**db_opts)
+    Finalize(MATCH_DB, MATCH_DB.close, exitpriority=100)
+
+
+def get_answer_score(answer_doc, match):
+    """Search through all the top docs to see if they have the answer (in a
+    worker process set up by init_answer_match).
+    """
+    answer, (doc_ids, doc_scores) = answer_doc
+    texts = MATCH_DB.get_doc_texts(doc_ids)
+    for text in texts:
+        if has_answer(answer, text, MATCH_TOK, match):
+            return 1
+    return 0
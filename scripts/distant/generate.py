@@ -54,9 +54,15 @@ def init(tokenizer_class, tokenizer_opts, db_class=None, db_opts=None):
         Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
 
 
-def fetch_text(doc_id):
+def fetch_paragraphs(doc_ids):
+    """Stored paragraphs if the db has them, else the texts split as always
+    (unstripped, so paragraph indices match older outputs).
+    """
     global PROCESS_DB
-    return PROCESS_DB.get_doc_text(doc_id)
+    if PROCESS_DB.has_paragraphs:
+        return PROCESS_DB.get_docs_paragraphs(doc_ids)
+    return [re.split(r'\n+', text or '')
+            for text in PROCESS_DB.get_doc_texts(doc_ids)]
 
 
 def tokenize_text(text):
@@ -165,8 +171,8 @@ def search_docs(inputs, max_ex=5, opts=None):
 
     doc_ids, q_tokens, answer = inputs
     examples = []
-    for i, doc_id in enumerate(doc_ids):
-        for j, paragraph in enumerate(re.split(r'\n+', fetch_text(doc_id))):
+    for i, paragraphs in enumerate(fetch_paragraphs(doc_ids)):
+        for j, paragraph in enumerate(paragraphs):
             found = find_answer(paragraph, q_tokens, answer, opts)
             if found:
                 # Reverse ranking, giving priority to early docs + paragraphs
@@ -13,7 +13,7 @@ import prettytable
 import logging
 
 from termcolor import colored
-from drqa import pipeline
+from drqa import pipeline, retriever
 from drqa.retriever import utils
 
 logger = logging.getLogger()
@@ -30,6 +30,12 @@ parser.add_argument('--retriever-model', type=str, default=None,
                     help='Path to Document Retriever model (tfidf)')
 parser.add_argument('--doc-db', type=str, default=None,
                     help='Path to Document DB')
+parser.add_argument('--doc-db-class', type=str, default='sqlite',
+                    help=("Document DB type: 'sqlite', or 'flat' (see "
+                          "build_flat_db.py)"))
+parser.add_argument('--token-store', type=str, default=None,
+                    help=('Path to pre-tokenized paragraphs of the Document '
+                          'DB (see pretokenize.py)'))
 parser.add_argument('--tokenizer', type=str, default=None,
                     help=("String option specifying tokenizer type to "
                           "use (e.g. 'corenlp')"))
@@ -66,8 +72,10 @@ DrQA = pipeline.DrQA(
     fixed_candidates=candidates,
     reader_model=args.reader_model,
     ranker_config={'options': {'tfidf_path': args.retriever_model}},
-    db_config={'options': {'db_path': args.doc_db}},
-    tokenizer=args.tokenizer
+    db_config={'class': retriever.get_class(args.doc_db_class),
+               'options': {'db_path': args.doc_db}},
+    tokenizer=args.tokenizer,
+    token_store=args.token_store
 )
 
 
@@ -13,7 +13,7 @@ import json
 import argparse
 import logging
 
-from drqa import pipeline
+from drqa import pipeline, retriever
 from drqa.retriever import utils
 
 
@@ -35,6 +35,12 @@ parser.add_argument('--retriever-model', type=str, default=None,
                     help="Path to Document Retriever model (tfidf)")
 parser.add_argument('--doc-db', type=str, default=None,
                     help='Path to Document DB')
+parser.add_argument('--doc-db-class', type=str, default='sqlite',
+                    help=("Document DB type: 'sqlite', or 'flat' (see "
+                          "build_flat_db.py)"))
+parser.add_argument('--token-store', type=str, default=None,
+                    help=('Path to pre-tokenized paragraphs of the Document '
+                          'DB (see pretokenize.py)'))
 parser.add_argument('--embedding-file', type=str, default=None,
                     help=("Expand dictionary to use all pretrained "
                           "embeddings in this file"))
@@ -92,8 +98,10 @@ DrQA = pipeline.DrQA(
     data_parallel=args.parallel,
     ranker_config={'options': {'tfidf_path': args.retriever_model,
                                'strict': False}},
-    db_config={'options': {'db_path': args.doc_db}},
+    db_config={'class': retriever.get_class(args.doc_db_class),
+               'options': {'db_path': args.doc_db}},
     num_workers=args.num_workers,
+    token_store=args.token_store,
 )
 
 
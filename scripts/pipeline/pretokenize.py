@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Tokenize every paragraph of a document db once, into a token store read
+by the full pipeline (see drqa.retriever.TokenStore).
+
+The annotators (pos, lemma, ner) are the ones the reader model uses.
+"""
+
+import argparse
+import time
+import logging
+
+from multiprocessing import Pool as ProcessPool
+from multiprocessing.util import Finalize
+
+from drqa import retriever, tokenizers
+from drqa.retriever.token_store import TokenStoreWriter
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+# ------------------------------------------------------------------------------
+# Multiprocessing functions
+# ------------------------------------------------------------------------------
+
+PROCESS_TOK = None
+PROCESS_DB = None
+
+
+def init(tokenizer_class, tokenizer_opts, db_opts):
+    global PROCESS_TOK, PROCESS_DB
+    PROCESS_TOK = tokenizer_class(**tokenizer_opts)
+    Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
+    PROCESS_DB = retriever.DocDB(**db_opts)
+    Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
+
+
+def tokenize_range(rowid_range):
+    """Fetch the paragraphs of the docs of a [start, end) rowid range and
+    tokenize them.
+    """
+    global PROCESS_TOK, PROCESS_DB
+    doc_ids = [doc_id for _, doc_id in PROCESS_DB.iter_doc_ids(*rowid_range)]
+    results = []
+    for doc_id, paragraphs in zip(doc_ids,
+                                  PROCESS_DB.get_docs_paragraphs(doc_ids)):
+        tokens = [PROCESS_TOK.tokenize(p) for p in paragraphs]
+        results.append((doc_id, paragraphs, tokens))
+    return results
+
+
+def get_annotators(args):
+    if args.annotators is not None:
+        return set(args.annotators)
+    # Only load the reader (and torch) to read its annotators.
+    from drqa import reader
+    from drqa.pipeline import DEFAULTS
+    model = reader.DocReader.load(args.reader_model or DEFAULTS['reader_model'],
+                                  normalize=False)
+    return tokenizers.get_annotators_for_model(model)
+
+
+# ------------------------------------------------------------------------------
+# Main.
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_path', type=str,
+                        help='Path to sqlite db holding document texts')
+    parser.add_argument('out_dir', type=str,
+                        help='Directory for saving the token store')
+    parser.add_argument('--reader-model', type=str, default=None,
+                        help='Reader model whose annotators are stored')
+    parser.add_argument('--annotators', type=str, nargs='*', default=None,
+                        help=('Annotators to store (pos, lemma, ner) instead '
+                              "of the reader model's"))
+    parser.add_argument('--tokenizer', type=str, default='corenlp',
+                        help=("String option specifying tokenizer type to use "
+                              "(same as the pipeline's)"))
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='Number of CPU processes (for tokenizing, etc)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Number of documents (rowids) per worker task')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    annotators = get_annotators(args)
+    logger.info('Annotators: %s' % sorted(annotators))
+    db_opts = {'db_path': args.db_path, 'read_only': True}
+    with retriever.DocDB(**db_opts) as doc_db:
+        num_docs = doc_db.get_num_docs()
+        ranges = doc_db.get_rowid_ranges(args.batch_size)
+
+    writer = TokenStoreWriter(args.out_dir, annotators, args.tokenizer)
+    tok_class = tokenizers.get_class(args.tokenizer)
+    workers = ProcessPool(
+        args.num_workers,
+        initializer=init,
+        initargs=(tok_class, {'annotators': annotators}, db_opts)
+    )
+    for i, results in enumerate(workers.imap(tokenize_range, ranges)):
+        for doc_id, paragraphs, tokens in results:
+            writer.add(doc_id, paragraphs, tokens)
+        if (i + 1) % 100 == 0:
+            logger.info('%d/%d docs, %d paragraphs, %d tokens' %
+                        (len(writer.doc_ids), num_docs,
+                         writer.num_paragraphs, writer.num_tokens))
+    workers.close()
+    workers.join()
+
+    logger.info('Saving to %s' % args.out_dir)
+    writer.close()
+    logger.info('Done: %d docs, %d paragraphs, %d tokens. Total time: %.2f '
+                '(s)' % (len(writer.doc_ids), writer.num_paragraphs,
+                         writer.num_tokens, time.time() - t0))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark the throughput and latency of the DrQA retriever module.
+
+Replays the questions of a dataset (eval.py format) against one or more
+ranker classes, over a sweep of k, batch size, number of workers and
+query-term pruning budget (whose cost is reported as the top-k overlap with
+unpruned rankings). Each ranker class runs in a fresh process, so its load
+time and peak RSS are its own. Results are printed (and optionally saved) as
+json.
+"""
+
+import argparse
+import inspect
+import itertools
+import json
+import logging
+import time
+import numpy as np
+
+from multiprocessing import Pool as ProcessPool
+
+from drqa import retriever
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+def replay(ranker, questions, k, batch_size, num_workers, budget):
+    """Rank all questions in calls of batch_size questions (closest_docs if
+    batch_size is 1). Returns the total time, the latency of every call and
+    the rankings.
+    """
+    budget_opts = {}
+    if budget is not None:
+        budget_opts = {'max_terms': budget[0], 'weight_frac': budget[1]}
+    latencies = []
+    ranked = []
+    start = time.time()
+    for i in range(0, len(questions), batch_size):
+        t0 = time.time()
+        if batch_size == 1:
+            ranked.append(ranker.closest_docs(questions[i], k=k,
+                                              **budget_opts))
+        else:
+            ranked.extend(ranker.batch_closest_docs(
+                questions[i:i + batch_size], k=k, num_workers=num_workers,
+                **budget_opts
+            ))
+        latencies.append(time.time() - t0)
+    return time.time() - start, np.array(latencies), ranked
+
+
+def overlap(ranked, ref_ranked):
+    """Average % of the reference top-k found in the top-k."""
+    return np.mean([len(set(docs[0]) & set(ref_docs[0])) /
+                    max(len(ref_docs[0]), 1)
+                    for docs, ref_docs in zip(ranked, ref_ranked)]) * 100
+
+
+def benchmark(name, args, questions):
+    """Load one ranker class and run the whole sweep on it."""
+    opts = dict(args.ranker_opts)
+    if name == 'fts5':
+        opts['db_path'] = args.doc_db
+    else:
+        opts['tfidf_paths' if name == 'sharded' else 'tfidf_path'] = args.model
+    opts.setdefault('strict', False)
+    # RSS is measured from the current RSS before loading: ru_maxrss is
+    # inherited from the parent process.
+    base_rss = retriever.utils.rss_mb()
+    has_peak = retriever.utils.reset_peak_rss()
+    t0 = time.time()
+    ranker = retriever.get_class(name)(**opts)
+    load_time = time.time() - t0
+    load_rss = peak_rss = retriever.utils.rss_mb()
+
+    # Warm up (tokenizer, page cache of memory-mapped models).
+    ranker.batch_closest_docs(questions[:args.warmup], k=max(args.k))
+
+    # Query-term budgets are only passed when swept, to rankers that prune.
+    budgets = [(m, w) for m in args.max_terms for w in args.weight_frac]
+    if budgets == [(0, 1)]:
+        budgets = [None]
+    elif 'max_terms' not in inspect.signature(ranker.closest_docs).parameters:
+        logger.warning('%s ranker has no query-term budget, not sweeping '
+                       'budgets' % name)
+        budgets = [None]
+    results = []
+    for k in args.k:
+        ref_ranked = ranker.batch_closest_docs(
+            questions, k=k, **({} if budgets == [None] else
+                               {'max_terms': 0, 'weight_frac': 1})
+        )
+        for budget, batch_size, num_workers in itertools.product(
+                budgets, args.batch_size, args.num_workers):
+            if batch_size == 1 and num_workers != args.num_workers[0]:
+                continue
+            logger.info('%s: k = %d, batch size = %d, workers = %d, '
+                        'budget = %s' %
+                        (name, k, batch_size, num_workers, budget))
+            # Every run starts with cold result caches.
+            if hasattr(ranker, 'clear_cache'):
+                ranker.clear_cache()
+            total, latencies, ranked = replay(ranker, questions, k,
+                                              batch_size, num_workers, budget)
+            if base_rss is not None:
+                peak_rss = (retriever.utils.rss_mb('VmHWM') if has_peak else
+                            max(peak_rss, retriever.utils.rss_mb()))
+            results.append({
+                'ranker': name,
+                'k': k,
+                'batch_size': batch_size,
+                'num_workers': num_workers,
+                'max_terms': budget[0] if budget else 0,
+                'weight_frac': budget[1] if budget else 1,
+                'qps': len(questions) / total,
+                'p50_ms': np.percentile(latencies, 50) * 1000,
+                'p95_ms': np.percentile(latencies, 95) * 1000,
+                'p99_ms': np.percentile(latencies, 99) * 1000,
+                'unpruned_overlap': overlap(ranked, ref_ranked),
+                'load_time_s': load_time,
+                'load_rss_mb': (None if base_rss is None else
+                                load_rss - base_rss),
+                'peak_rss_mb': (None if base_rss is None else
+                                peak_rss - base_rss),
+            })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset', type=str,
+                        help='Questions to replay (eval.py format)')
+    parser.add_argument('--model', type=str, default=None,
+                        help='Path to the model (or glob of shards)')
+    parser.add_argument('--ranker', type=str, nargs='+', default=['tfidf'],
+                        help="Ranker classes (e.g. 'tfidf', 'maxscore')")
+    parser.add_argument('--doc-db', type=str, default=None,
+                        help='Path to Document DB (for the fts5 ranker)')
+    parser.add_argument('--ranker-opts', type=json.loads, default={},
+                        help='Extra ranker options, as a json object')
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--batch-size', type=int, nargs='+',
+                        default=[1, 32, 256, 1024],
+                        help='Questions per call (1 = closest_docs)')
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[1],
+                        help=('Threads per batch_closest_docs call (used for '
+                              'batches over the ranker BATCH_SIZE)'))
+    parser.add_argument('--max-terms', type=int, nargs='+', default=[0],
+                        help=('Query-term budgets: keep the N highest-idf '
+                              'terms (0 = all)'))
+    parser.add_argument('--weight-frac', type=float, nargs='+', default=[1],
+                        help=('Query-term budgets: keep the terms covering '
+                              'this fraction of the query weight (1 = all)'))
+    parser.add_argument('--num-questions', type=int, default=None,
+                        help='Only replay the first N questions')
+    parser.add_argument('--warmup', type=int, default=100,
+                        help='Number of questions to rank before timing')
+    parser.add_argument('--out-file', type=str, default=None,
+                        help='Also save the results to this json file')
+    args = parser.parse_args()
+
+    questions = []
+    for line in open(args.dataset):
+        questions.append(json.loads(line)['question'])
+    questions = questions[:args.num_questions]
+    logger.info('Replaying %d questions' % len(questions))
+
+    report = {
+        'model': args.model,
+        'dataset': args.dataset,
+        'num_questions': len(questions),
+        'results': [],
+    }
+    for name in args.ranker:
+        with ProcessPool(1) as process:
+            report['results'].extend(
+                process.apply(benchmark, (name, args, questions))
+            )
+        # Save as we go: a failing ranker keeps the results of the others.
+        if args.out_file:
+            with open(args.out_file, 'w') as f:
+                json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
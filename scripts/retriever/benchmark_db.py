@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark document lookups in one or more DocDBs.
+
+Random doc ids are fetched with get_doc_text from a number of threads, with
+the default (one shared connection) and the read_only (per-thread
+connections) modes, and lookups/sec and latency percentiles are printed.
+
+A storage report compares the dbs (e.g. built with different build_db.py
+--compress codecs): file size, latency of lookups on a cold page cache
+(evicted with posix_fadvise), and CPU time spent decompressing texts.
+"""
+
+import argparse
+import os
+import sqlite3
+import random
+import time
+import logging
+import numpy as np
+import prettytable
+
+from multiprocessing.pool import ThreadPool
+
+from drqa import retriever
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+def lookup(doc_db, doc_ids):
+    """Fetch doc_ids one by one, returning the latency of every lookup."""
+    latencies = []
+    for doc_id in doc_ids:
+        t0 = time.time()
+        doc_db.get_doc_text(doc_id)
+        latencies.append(time.time() - t0)
+    return latencies
+
+
+def benchmark(db_opts, doc_ids, num_threads):
+    """Split doc_ids between num_threads threads, looking them up at once."""
+    with retriever.DocDB(**db_opts) as doc_db, \
+            ThreadPool(num_threads) as threads:
+        # Warm up (opens the connections of read_only mode).
+        threads.map(lambda _: lookup(doc_db, doc_ids[:10]),
+                    range(num_threads))
+        parts = [doc_ids[i::num_threads] for i in range(num_threads)]
+        t0 = time.time()
+        latencies = threads.map(lambda part: lookup(doc_db, part), parts)
+        total = time.time() - t0
+    return total, np.concatenate(latencies)
+
+
+def evict(path):
+    """Drop the (clean) pages of a file from the OS page cache."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def storage_report(db_path, doc_ids):
+    """Size, cold cache lookup latency and decompression cost of a db."""
+    evict(db_path)
+    with retriever.DocDB(db_path) as doc_db:
+        latencies = lookup(doc_db, doc_ids)
+        codec = doc_db.codec
+
+    # Time decompression alone, on the stored (raw) values.
+    conn = sqlite3.connect(db_path)
+    raw = [conn.execute("SELECT text FROM documents WHERE id = ?",
+                        (retriever.utils.normalize(doc_id),)).fetchone()[0]
+           for doc_id in doc_ids]
+    conn.close()
+    t0 = time.process_time()
+    texts = [codec.decompress(data) for data in raw]
+    cpu = time.process_time() - t0
+    text_bytes = sum(len(text.encode('utf-8')) for text in texts)
+    return [
+        os.path.basename(db_path), codec.name,
+        '%.1f' % (os.path.getsize(db_path) / 1024 ** 2),
+        '%.3f' % (np.percentile(latencies, 50) * 1000),
+        '%.3f' % (np.mean(latencies) * 1000),
+        '%.1f' % (cpu / len(doc_ids) * 1e6),
+        '%.0f' % (text_bytes / 1024 ** 2 / max(cpu, 1e-9)),
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_paths', type=str, nargs='+',
+                        help=('Path(s) to sqlite dbs holding the same '
+                              'documents'))
+    parser.add_argument('--num-lookups', type=int, default=100000)
+    parser.add_argument('--num-cold-lookups', type=int, default=1000,
+                        help='Lookups timed on a cold page cache')
+    parser.add_argument('--num-threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument('--mmap-size', type=int, default=2 ** 30,
+                        help='Bytes to memory-map in read_only mode')
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help='Page cache per connection (MB), read_only mode')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with retriever.DocDB(args.db_paths[0]) as doc_db:
+        all_ids = doc_db.get_doc_ids()
+    random.seed(args.seed)
+    doc_ids = [random.choice(all_ids) for _ in range(args.num_lookups)]
+    logger.info('%d lookups among %d docs' % (len(doc_ids), len(all_ids)))
+
+    table = prettytable.PrettyTable(
+        ['DB', 'Mode', 'Threads', 'Lookups/s', 'p50 (ms)', 'p99 (ms)']
+    )
+    for db_path in args.db_paths:
+        modes = [
+            ('default', {'db_path': db_path}),
+            ('read_only', {'db_path': db_path, 'read_only': True,
+                           'mmap_size': args.mmap_size,
+                           'cache_size': args.cache_size}),
+        ]
+        for num_threads in args.num_threads:
+            for mode, db_opts in modes:
+                logger.info('%s, %s: %d threads' %
+                            (db_path, mode, num_threads))
+                total, latencies = benchmark(db_opts, doc_ids, num_threads)
+                table.add_row([
+                    os.path.basename(db_path), mode, num_threads,
+                    '%.0f' % (len(doc_ids) / total),
+                    '%.3f' % (np.percentile(latencies, 50) * 1000),
+                    '%.3f' % (np.percentile(latencies, 99) * 1000),
+                ])
+    print(table)
+
+    logger.info('Storage report...')
+    table = prettytable.PrettyTable(
+        ['DB', 'Codec', 'Size (MB)', 'Cold p50 (ms)', 'Cold mean (ms)',
+         'Decompress (us/doc)', 'Decompress (MB/s)']
+    )
+    cold_ids = random.sample(all_ids, min(args.num_cold_lookups,
+                                          len(all_ids)))
+    for db_path in args.db_paths:
+        table.add_row(storage_report(db_path, cold_ids))
+    print(table)
@@ -10,6 +10,9 @@ import argparse
 import sqlite3
 import json
 import os
+import bz2
+import gzip
+import time
 import logging
 import importlib.util
 
@@ -31,12 +34,16 @@ logger.addHandler(console)
 
 
 PREPROCESS_FN = None
+CODEC = None
+PARAGRAPHS = False
 
 
-def init(filename):
-    global PREPROCESS_FN
+def init(filename, codec=None, paragraphs=False):
+    global PREPROCESS_FN, CODEC, PARAGRAPHS
     if filename:
         PREPROCESS_FN = import_module(filename).preprocess
+    CODEC = codec
+    PARAGRAPHS = paragraphs
 
 
 def import_module(filename):
@@ -64,11 +71,26 @@ def iter_files(path):
         raise RuntimeError('Path %s is invalid' % path)
 
 
+def open_file(filename):
+    """Open a text file, decompressing .bz2 and .gz files as it is read."""
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rt')
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    return open(filename)
+
+
 def get_contents(filename):
-    """Parse the contents of a file. Each line is a JSON encoded document."""
-    global PREPROCESS_FN
-    documents = []
-    with open(filename) as f:
+    """Parse the contents of a file. Each line is a JSON encoded document.
+
+    Returns (id, text) documents, and (doc_id, idx, text, doc_num)
+    paragraphs if they are stored, where doc_num is the position of their
+    document in the returned ones. Texts are compressed if a codec was set.
+    """
+    global PREPROCESS_FN, CODEC, PARAGRAPHS
+    compress = CODEC.compress if CODEC else lambda text: text
+    documents, paragraphs = [], []
+    with open_file(filename) as f:
         for line in f:
             # Parse document
             doc = json.loads(line)
@@ -78,12 +100,106 @@ def get_contents(filename):
             # Skip if it is empty or None
             if not doc:
                 continue
-            # Add the document
-            documents.append((utils.normalize(doc['id']), doc['text']))
-    return documents
+            # Add the document (and its paragraphs)
+            doc_id = utils.normalize(doc['id'])
+            documents.append((doc_id, compress(doc['text'])))
+            if PARAGRAPHS:
+                for idx, text in enumerate(
+                        utils.split_paragraphs(doc['text'])):
+                    paragraphs.append((doc_id, idx, compress(text),
+                                       len(documents) - 1))
+    return documents, paragraphs
+
+
+def get_codec(files, preprocess, compress, level, dict_size, dict_samples):
+    """Set up the text codec. A zstd dictionary is trained on the documents
+    of the first files, up to dict_samples of them.
+    """
+    dictionary = None
+    if compress == 'zstd' and dict_size:
+        logger.info('Training zstd dictionary...')
+        init(preprocess)
+        samples = []
+        for filename in files:
+            documents, _ = get_contents(filename)
+            samples.extend(text for _, text in documents)
+            if len(samples) >= dict_samples:
+                break
+        dictionary = utils.TextCodec.train_dictionary(
+            samples[:dict_samples], dict_size
+        )
+    return utils.TextCodec(compress, level, dictionary)
+
+
+def create_tables(c, codec, paragraphs=False, fast=False):
+    """Create the db tables. In fast mode, the id indices are only created
+    by finish_fast (after all inserts), a progress table records the files
+    already stored, and paragraphs record the rowid of their document.
+    """
+    if fast:
+        c.execute("CREATE TABLE documents (id TEXT, text);")
+        if paragraphs:
+            c.execute("CREATE TABLE paragraphs (doc_id TEXT, idx INTEGER, "
+                      "text, doc_rowid INTEGER);")
+        c.execute("CREATE TABLE progress (filename TEXT PRIMARY KEY, "
+                  "documents INTEGER, paragraphs INTEGER);")
+    else:
+        c.execute("CREATE TABLE documents (id PRIMARY KEY, text);")
+        if paragraphs:
+            c.execute("CREATE TABLE paragraphs (doc_id, idx, text, "
+                      "PRIMARY KEY (doc_id, idx));")
+    c.execute("CREATE TABLE meta (key PRIMARY KEY, value);")
+    c.execute("INSERT INTO meta VALUES ('codec', ?)", (codec.name,))
+    if codec.dictionary:
+        c.execute("INSERT INTO meta VALUES ('zstd_dict', ?)",
+                  (codec.dictionary,))
 
 
-def store_contents(data_path, save_path, preprocess, num_workers=None):
+def get_progress(c, paragraphs, level=None):
+    """Read back the state of an interrupted fast build: files already
+    stored, and the codec. Rows past the last commit are deleted.
+    """
+    tables = {r[0] for r in c.execute("SELECT name FROM sqlite_master")}
+    if 'progress' not in tables:
+        raise RuntimeError('No progress to resume (not a --fast build, or '
+                           'already finished)')
+    if paragraphs != ('paragraphs' in tables):
+        raise RuntimeError('--paragraphs does not match the resumed build')
+    done = {r[0] for r in c.execute("SELECT filename FROM progress")}
+    c.execute("SELECT MAX(documents), MAX(paragraphs) FROM progress")
+    max_docs, max_paragraphs = c.fetchone()
+    c.execute("DELETE FROM documents WHERE rowid > ?", (max_docs or 0,))
+    if paragraphs:
+        c.execute("DELETE FROM paragraphs WHERE rowid > ?",
+                  (max_paragraphs or 0,))
+    meta = dict(c.execute("SELECT key, value FROM meta"))
+    codec = utils.TextCodec(meta['codec'], level,
+                            dictionary=meta.get('zstd_dict'))
+    return done, codec
+
+
+def finish_fast(c, paragraphs):
+    """Index the ids of a fast build (keeping the first of any duplicate
+    docs, and its paragraphs only) and drop its progress table.
+    """
+    logger.info('Creating indices...')
+    c.execute("DELETE FROM documents WHERE rowid NOT IN "
+              "(SELECT MIN(rowid) FROM documents GROUP BY id)")
+    if c.rowcount:
+        logger.warning('Dropped %d duplicate docs' % c.rowcount)
+    c.execute("CREATE UNIQUE INDEX documents_id ON documents (id);")
+    if paragraphs:
+        c.execute("DELETE FROM paragraphs WHERE doc_rowid NOT IN "
+                  "(SELECT rowid FROM documents)")
+        c.execute("CREATE UNIQUE INDEX paragraphs_doc_idx ON paragraphs "
+                  "(doc_id, idx);")
+    c.execute("DROP TABLE progress;")
+
+
+def store_contents(data_path, save_path, preprocess, num_workers=None,
+                   compress='none', level=None, dict_size=0,
+                   dict_samples=10000, paragraphs=False, fast=False,
+                   resume=False, commit_every=100):
     """Preprocess and store a corpus of documents in sqlite.
 
     Args:
@@ -93,27 +209,104 @@ def store_contents(data_path, save_path, preprocess, num_workers=None):
         preprocess: Path to file defining a custom `preprocess` function. Takes
           in and outputs a structured doc.
         num_workers: Number of parallel processes to use when reading docs.
+        compress: Codec of the stored texts ('none', 'zlib' or 'zstd'),
+          recorded in the meta table.
+        level: Compression level (codec default if None).
+        dict_size: Size (bytes) of the zstd dictionary (0 = no dictionary).
+        dict_samples: Number of documents to train the dictionary on.
+        paragraphs: Also store the paragraphs of every document (see
+          utils.split_paragraphs) in a paragraphs table.
+        fast: Bulk ingestion mode: no journal and no fsync during the load,
+          id indices created after it, and a commit every commit_every
+          files, recorded in a progress table (see resume).
+        resume: Continue an interrupted fast build of save_path, skipping
+          the files it committed.
+        commit_every: Number of files stored per commit (fast mode).
     """
-    if os.path.isfile(save_path):
+    if resume and not fast:
+        raise RuntimeError('Only --fast builds can be resumed')
+    if os.path.isfile(save_path) and not resume:
         raise RuntimeError('%s already exists! Not overwriting.' % save_path)
 
-    logger.info('Reading into database...')
+    files = [f for f in iter_files(data_path)]
     conn = sqlite3.connect(save_path)
     c = conn.cursor()
-    c.execute("CREATE TABLE documents (id PRIMARY KEY, text);")
+    if fast:
+        # A crash during the load can corrupt the db: it is resumed from the
+        # last commit, or rebuilt.
+        c.execute("PRAGMA journal_mode = OFF;")
+        c.execute("PRAGMA synchronous = OFF;")
+        c.execute("PRAGMA cache_size = -262144;")
+    if resume and os.path.getsize(save_path) > 0:
+        done, codec = get_progress(c, paragraphs, level)
+        files = [f for f in files if f not in done]
+        logger.info('Resuming: %d files stored, %d left' %
+                    (len(done), len(files)))
+    else:
+        codec = get_codec(files, preprocess, compress, level, dict_size,
+                          dict_samples)
+        create_tables(c, codec, paragraphs, fast)
+    conn.commit()
 
-    workers = ProcessPool(num_workers, initializer=init, initargs=(preprocess,))
-    files = [f for f in iter_files(data_path)]
-    count = 0
-    with tqdm(total=len(files)) as pbar:
-        for pairs in tqdm(workers.imap_unordered(get_contents, files)):
-            count += len(pairs)
-            c.executemany("INSERT INTO documents VALUES (?,?)", pairs)
-            pbar.update()
-    logger.info('Read %d docs.' % count)
+    logger.info('Reading into database...')
+    t0 = time.time()
+    workers = ProcessPool(num_workers, initializer=init,
+                          initargs=(preprocess, codec, paragraphs))
+    count, num_paragraphs = 0, 0
+    try:
+        with tqdm(total=len(files)) as pbar:
+            for i, (filename, (pairs, triples)) in enumerate(zip(
+                    files, workers.imap(get_contents, files)
+            )):
+                count += len(pairs)
+                num_paragraphs += len(triples)
+                # New rows are numbered from the highest rowid stored.
+                first = c.execute("SELECT IFNULL(MAX(rowid), 0) + 1 FROM "
+                                  "documents").fetchone()[0]
+                c.executemany("INSERT INTO documents VALUES (?,?)", pairs)
+                if paragraphs and fast:
+                    # Tagged with their document's rowid, for finish_fast.
+                    c.executemany(
+                        "INSERT INTO paragraphs VALUES (?,?,?,?)",
+                        ((doc_id, idx, text, first + doc_num)
+                         for doc_id, idx, text, doc_num in triples)
+                    )
+                elif paragraphs:
+                    c.executemany("INSERT INTO paragraphs VALUES (?,?,?)",
+                                  (triple[:3] for triple in triples))
+                if fast:
+                    # Highest rowids stored so far (rows past them are
+                    # dropped on resume).
+                    c.execute(
+                        "INSERT INTO progress VALUES (?, "
+                        "(SELECT MAX(rowid) FROM documents), %s)" %
+                        ("(SELECT MAX(rowid) FROM paragraphs)" if paragraphs
+                         else "NULL"), (filename,)
+                    )
+                    if (i + 1) % commit_every == 0:
+                        conn.commit()
+                pbar.update()
+    except BaseException:
+        # Do not wait for pending files on failure.
+        workers.terminate()
+        raise
+    workers.close()
+    workers.join()
+    load_time = time.time() - t0
+    logger.info('Read %d docs in %.1f (s): %.0f docs/sec.' %
+                (count, load_time, count / max(load_time, 1e-9)))
+    if paragraphs:
+        logger.info('Stored %d paragraphs.' % num_paragraphs)
     logger.info('Committing...')
     conn.commit()
+    if fast:
+        finish_fast(c, paragraphs)
+        conn.commit()
+        c.execute("PRAGMA journal_mode = DELETE;")
     conn.close()
+    total_time = time.time() - t0
+    logger.info('Done in %.1f (s): %.0f docs/sec overall.' %
+                (total_time, count / max(total_time, 1e-9)))
 
 
 # ------------------------------------------------------------------------------
@@ -130,8 +323,31 @@ if __name__ == '__main__':
                               'a `preprocess` function'))
     parser.add_argument('--num-workers', type=int, default=None,
                         help='Number of CPU processes (for tokenizing, etc)')
+    parser.add_argument('--compress', type=str, default='none',
+                        choices=utils.TextCodec.CODECS,
+                        help='Store document texts compressed')
+    parser.add_argument('--compress-level', type=int, default=None,
+                        help='Compression level (default: codec default)')
+    parser.add_argument('--zstd-dict-size', type=int, default=112640,
+                        help=('Size (bytes) of the zstd dictionary trained on '
+                              'sample documents (0 = no dictionary)'))
+    parser.add_argument('--zstd-dict-samples', type=int, default=10000,
+                        help='Number of documents to train the dictionary on')
+    parser.add_argument('--paragraphs', action='store_true',
+                        help=('Also store documents split into paragraphs '
+                              '(read by the full pipeline)'))
+    parser.add_argument('--fast', action='store_true',
+                        help=('Bulk ingestion: no journal or fsync, deferred '
+                              'indexing and resumable batched commits'))
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted --fast build of save_path')
+    parser.add_argument('--commit-every', type=int, default=100,
+                        help='Number of files per commit (with --fast)')
     args = parser.parse_args()
 
     store_contents(
-        args.data_path, args.save_path, args.preprocess, args.num_workers
+        args.data_path, args.save_path, args.preprocess, args.num_workers,
+        args.compress, args.compress_level, args.zstd_dict_size,
+        args.zstd_dict_samples, args.paragraphs, args.fast, args.resume,
+        args.commit_every
     )
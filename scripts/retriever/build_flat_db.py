@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Convert a sqlite document db into a flat, memory-mapped one (FlatDocDB).
+
+With --tfidf-path, docs are laid out in the doc index order of a tf-idf
+model, so ranker doc indices are flat db doc indices.
+"""
+
+import argparse
+import time
+import logging
+
+from drqa import retriever
+from drqa.retriever import utils
+from drqa.retriever.flat_doc_db import FlatDocDBWriter
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+def get_doc_ids(doc_db, tfidf_path=None):
+    """Doc ids in output order: the tf-idf model's doc indices first (if
+    given), then any other docs of the db, in rowid order (the doc index
+    order of build_tfidf.py).
+    """
+    db_ids = [doc_id for _, doc_id in doc_db.iter_doc_ids()]
+    if not tfidf_path:
+        return db_ids
+    logger.info('Reading doc ids of %s' % tfidf_path)
+    _, metadata = utils.load_sparse_csr(tfidf_path)
+    doc_ids = list(metadata['doc_dict'])
+    known = set(doc_ids)
+    extra = [doc_id for doc_id in db_ids if doc_id not in known]
+    if extra:
+        logger.warning('%d docs are not in the tf-idf model, appending them '
+                       'after its %d docs' % (len(extra), len(doc_ids)))
+    return doc_ids + extra
+
+
+def convert(db_path, out_dir, tfidf_path=None, batch_size=1000):
+    writer = FlatDocDBWriter(out_dir, tfidf_path)
+    with retriever.DocDB(db_path, read_only=True) as doc_db:
+        doc_ids = get_doc_ids(doc_db, tfidf_path)
+        missing = 0
+        for i in range(0, len(doc_ids), batch_size):
+            batch = doc_ids[i:i + batch_size]
+            texts = doc_db.get_doc_texts(batch)
+            paragraphs = doc_db.get_docs_paragraphs(batch)
+            for doc_id, text, doc_paragraphs in zip(batch, texts, paragraphs):
+                if text is None:
+                    # Keep doc indices aligned with the model.
+                    missing += 1
+                    text = ''
+                writer.add(doc_id, text, doc_paragraphs)
+            if (i // batch_size + 1) % 100 == 0:
+                logger.info('%d/%d docs' % (i + len(batch), len(doc_ids)))
+    if missing:
+        logger.warning('%d docs of the tf-idf model are not in the db, stored '
+                       'as empty texts' % missing)
+    writer.close()
+    return len(writer.doc_ids), writer.num_paragraphs, writer.num_bytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_path', type=str,
+                        help='Path to sqlite db holding document texts')
+    parser.add_argument('out_dir', type=str,
+                        help='Directory for saving the flat db')
+    parser.add_argument('--tfidf-path', type=str, default=None,
+                        help=('Lay docs out in the doc index order of this '
+                              'tf-idf model'))
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Number of documents read per query')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    num_docs, num_paragraphs, num_bytes = convert(
+        args.db_path, args.out_dir, args.tfidf_path, args.batch_size
+    )
+    logger.info('Done: %d docs, %d paragraphs, %.1f MB of text. Total time: '
+                '%.2f (s)' % (num_docs, num_paragraphs, num_bytes / 1024 ** 2,
+                              time.time() - t0))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""A script to build an FTS5 full-text index inside a document db.
+
+The index is an external content table over the documents table (texts are
+not stored twice), used by the fts5 ranker (Fts5DocRanker).
+"""
+
+import argparse
+import sqlite3
+import time
+import logging
+
+from drqa.retriever import DocDB, Fts5DocRanker
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+def build_index(db_path, tokenize, detail, overwrite=False):
+    """Create (or recreate) the FTS5 table and index all documents."""
+    table = Fts5DocRanker.TABLE
+    with DocDB(db_path) as doc_db:
+        if doc_db.codec.name != 'none':
+            raise RuntimeError('%s stores %s compressed texts, which FTS5 '
+                               'can not index' % (db_path, doc_db.codec.name))
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE name = ?", (table,))
+    if c.fetchone() is not None:
+        if not overwrite:
+            raise RuntimeError('%s already has an FTS5 index! Use '
+                               '--overwrite to rebuild it.' % db_path)
+        logger.info('Dropping the existing index...')
+        c.execute("DROP TABLE %s" % table)
+
+    c.execute(
+        "CREATE VIRTUAL TABLE %s USING fts5(text, content='documents', "
+        "content_rowid='rowid', tokenize='%s', detail=%s)" %
+        (table, tokenize.replace("'", "''"), detail)
+    )
+    logger.info('Indexing documents...')
+    c.execute("INSERT INTO %s(%s) VALUES('rebuild')" % (table, table))
+    logger.info('Merging index segments...')
+    c.execute("INSERT INTO %s(%s) VALUES('optimize')" % (table, table))
+    conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_path', type=str,
+                        help='Path to sqlite db holding document texts')
+    parser.add_argument('--tokenize', type=str,
+                        default='unicode61 remove_diacritics 2',
+                        help='FTS5 tokenizer spec')
+    parser.add_argument('--detail', type=str, default='full',
+                        choices=['full', 'column'],
+                        help=("FTS5 detail level ('column' gives a smaller "
+                              "index, without phrase positions)"))
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Rebuild the index if there is one')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    build_index(args.db_path, args.tokenize, args.detail, args.overwrite)
+    logger.info('Done. Total time: %.2f (s)' % (time.time() - t0))
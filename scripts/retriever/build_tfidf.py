@@ -10,13 +10,14 @@ import numpy as np
 import scipy.sparse as sp
 import argparse
 import os
+import sys
 import math
+import tempfile
 import logging
 
 from multiprocessing import Pool as ProcessPool
 from multiprocessing.util import Finalize
 from functools import partial
-from collections import Counter
 
 from drqa import retriever
 from drqa import tokenizers
@@ -33,7 +34,6 @@ logger.addHandler(console)
 # Multiprocessing functions
 # ------------------------------------------------------------------------------
 
-DOC2IDX = None
 PROCESS_TOK = None
 PROCESS_DB = None
 
@@ -46,11 +46,6 @@ def init(tokenizer_class, db_class, db_opts):
     Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
 
 
-def fetch_text(doc_id):
-    global PROCESS_DB
-    return PROCESS_DB.get_doc_text(doc_id)
-
-
 def tokenize(text):
     global PROCESS_TOK
     return PROCESS_TOK.tokenize(text)
@@ -60,40 +55,102 @@ def tokenize(text):
 # Build article --> word count sparse matrix.
 # ------------------------------------------------------------------------------
 
+# Number of rowids (documents) counted per worker task.
+WORKER_BATCH_SIZE = 100
 
-def count(ngram, hash_size, doc_id):
-    """Fetch the text of a document and compute hashed ngrams counts."""
-    global DOC2IDX
-    row, col, data = [], [], []
+
+def count(ngram, hash_size, doc_index, text):
+    """Compute hashed ngrams counts of a document (column doc_index)."""
     # Tokenize
-    tokens = tokenize(retriever.utils.normalize(fetch_text(doc_id)))
+    tokens = tokenize(retriever.utils.normalize(text))
 
-    # Get ngrams from tokens, with stopword/punctuation filtering.
-    ngrams = tokens.ngrams(
-        n=ngram, uncased=True, filter_fn=retriever.utils.filter_ngram
+    # Get ngrams from tokens, with stopword/punctuation filtering, then hash
+    # them and count occurences.
+    row, data = retriever.utils.hash_ngrams(
+        tokens.words(uncased=True), ngram, hash_size
     )
 
-    # Hash ngrams and count occurences
-    counts = Counter([retriever.utils.hash(gram, hash_size) for gram in ngrams])
-
     # Return in sparse matrix data format.
-    row.extend(counts.keys())
-    col.extend([DOC2IDX[doc_id]] * len(counts))
-    data.extend(counts.values())
-    return row, col, data
+    col = np.full(len(row), doc_index, dtype=np.int32)
+    return row.astype(np.int32), col, data.astype(np.int32)
 
 
-def get_count_matrix(args, db, db_opts):
+def count_range(ngram, hash_size, rowid_range):
+    """Compute hashed ngram counts for the documents of a [start, end) rowid
+    range, read by the worker itself. Returns their ids, and one compact
+    chunk of (row, col, data) arrays (columns index docs within the range).
+    """
+    global PROCESS_DB
+    doc_ids, counts = [], [(np.zeros(0, dtype=np.int32),) * 3]
+    for _, doc_id, text in PROCESS_DB.iter_docs(*rowid_range):
+        counts.append(count(ngram, hash_size, len(doc_ids), text))
+        doc_ids.append(doc_id)
+    return doc_ids, tuple(np.concatenate(arrays) for arrays in zip(*counts))
+
+
+def spill_chunk(row, col, data, tmp_dir, chunk_id):
+    """Sort a chunk of (row, col, data) triples by row and write it to disk."""
+    order = np.lexsort((col, row))
+    paths = []
+    for name, array in (('row', row), ('col', col), ('data', data)):
+        path = os.path.join(tmp_dir, 'chunk-%d-%s.npy' % (chunk_id, name))
+        np.save(path, array[order])
+        paths.append(path)
+    return paths
+
+
+def merge_chunks(chunks, shape):
+    """Merge row-sorted chunks of (row, col, data) triples into a csr matrix.
+
+    Chunks are memory-mapped and read one at a time: a first pass counts the
+    entries of every row, a second one copies each chunk's row segments in
+    place in the final indices and data arrays.
+    """
+    def _load(paths):
+        return [np.load(path, mmap_mode='r') for path in paths]
+
+    row_counts = np.zeros(shape[0], dtype=np.int64)
+    for paths in chunks:
+        row_counts += np.bincount(_load(paths)[0], minlength=shape[0])
+    nnz = int(row_counts.sum())
+    idx_dtype = np.int32 if nnz < np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(shape[0] + 1, dtype=idx_dtype)
+    np.cumsum(row_counts, out=indptr[1:])
+    indices = np.empty(nnz, dtype=idx_dtype)
+    data = np.empty(nnz, dtype=np.int32)
+
+    next_pos = indptr[:-1].astype(np.int64)
+    for paths in chunks:
+        row, col, chunk_data = _load(paths)
+        # Offset of every entry within its row segment of this chunk.
+        within = np.arange(len(row)) - np.searchsorted(row, row)
+        pos = next_pos[row] + within
+        indices[pos] = col
+        data[pos] = chunk_data
+        next_pos += np.bincount(row, minlength=shape[0])
+
+    matrix = sp.csr_matrix((data, indices, indptr), shape=shape)
+    matrix.sum_duplicates()
+    return matrix
+
+
+def get_count_matrix(args, db, db_opts, rowid_range=(None, None)):
     """Form a sparse word to document count matrix (inverted index).
 
     M[i, j] = # times word i appears in document j.
+
+    Workers are handed ranges of rowids and read their documents from the
+    db themselves; documents are indexed in rowid order. Counts are
+    computed by the workers as compact numpy chunks. Buffered chunks are
+    sorted and spilled to disk whenever they exceed args.max_memory MB, and
+    merged into the final matrix at the end, so peak memory does not grow
+    with the corpus (beyond the final matrix and doc ids).
+    Only counts the documents of a [start, end) rowid_range if given
+    (default: all documents of the db).
     """
-    # Map doc_ids to indexes
-    global DOC2IDX
     db_class = retriever.get_class(db)
     with db_class(**db_opts) as doc_db:
-        doc_ids = doc_db.get_doc_ids()
-    DOC2IDX = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        ranges = doc_db.get_rowid_ranges(WORKER_BATCH_SIZE, *rowid_range)
 
     # Setup worker pool
     tok_class = tokenizers.get_class(args.tokenizer)
@@ -105,25 +162,110 @@ def get_count_matrix(args, db, db_opts):
 
     # Compute the count matrix in steps (to keep in memory)
     logger.info('Mapping...')
-    row, col, data = [], [], []
-    step = max(int(len(doc_ids) / 10), 1)
-    batches = [doc_ids[i:i + step] for i in range(0, len(doc_ids), step)]
-    _count = partial(count, args.ngram, args.hash_size)
+    tmp_dir = tempfile.TemporaryDirectory(dir=args.tmp_dir)
+    max_bytes = args.max_memory * 1024 * 1024
+    buffer, buffer_bytes, chunks = [], 0, []
+
+    def _spill():
+        nonlocal buffer, buffer_bytes
+        row, col, data = (np.concatenate(a) for a in zip(*buffer))
+        logger.info('Spilling chunk %d (%d entries)' % (len(chunks), len(row)))
+        chunks.append(spill_chunk(row, col, data, tmp_dir.name, len(chunks)))
+        buffer, buffer_bytes = [], 0
+
+    step = max(int(len(ranges) / 10), 1)
+    batches = [ranges[i:i + step] for i in range(0, len(ranges), step)]
+    _count = partial(count_range, args.ngram, args.hash_size)
+    doc_ids = []
     for i, batch in enumerate(batches):
         logger.info('-' * 25 + 'Batch %d/%d' % (i + 1, len(batches)) + '-' * 25)
-        for b_row, b_col, b_data in workers.imap_unordered(_count, batch):
-            row.extend(b_row)
-            col.extend(b_col)
-            data.extend(b_data)
+        # In order, so range columns are offset by the docs before them.
+        for range_ids, (row, col, data) in workers.imap(_count, batch):
+            counts = (row, col + len(doc_ids), data)
+            doc_ids.extend(range_ids)
+            buffer.append(counts)
+            buffer_bytes += sum(a.nbytes for a in counts)
+            # Sorting a chunk takes about twice its size.
+            if 2 * buffer_bytes >= max_bytes:
+                _spill()
     workers.close()
     workers.join()
+    if buffer:
+        _spill()
 
-    logger.info('Creating sparse matrix...')
-    count_matrix = sp.csr_matrix(
-        (data, (row, col)), shape=(args.hash_size, len(doc_ids))
-    )
-    count_matrix.sum_duplicates()
-    return count_matrix, (DOC2IDX, doc_ids)
+    logger.info('Merging %d chunks into sparse matrix...' % len(chunks))
+    count_matrix = merge_chunks(chunks, shape=(args.hash_size, len(doc_ids)))
+    tmp_dir.cleanup()
+    return count_matrix, retriever.utils.DocDict.from_ids(doc_ids)
+
+
+# ------------------------------------------------------------------------------
+# Count shards: independent (resumable) count jobs, merged at the end.
+# ------------------------------------------------------------------------------
+
+
+def get_count_shard_path(count_dir, shard, num_shards):
+    return os.path.join(count_dir, 'counts-shard=%d-of-%d.npz' %
+                        (shard, num_shards))
+
+
+def count_shard(args, db, db_opts, shard, path):
+    """Count the shard-th of args.count_shards contiguous rowid ranges of the
+    db and save its counts and doc frequencies.
+
+    The file is written under a temporary name and renamed when complete, so
+    an interrupted job leaves nothing behind and is simply run again.
+    """
+    with retriever.get_class(db)(**db_opts) as doc_db:
+        num_docs = doc_db.get_num_docs()
+        start, end = doc_db.get_rowid_bounds()
+    bounds = np.linspace(start, end, args.count_shards + 1).astype(int)
+    rowid_range = (int(bounds[shard]), int(bounds[shard + 1]))
+    logger.info('Counting shard %d/%d (rowids %d-%d)...' %
+                (shard + 1, args.count_shards, rowid_range[0],
+                 rowid_range[1] - 1))
+    count_matrix, doc_dict = get_count_matrix(args, db, db_opts, rowid_range)
+    metadata = {
+        'doc_freqs': get_doc_freqs(count_matrix),
+        'doc_dict': doc_dict,
+        'shard': shard,
+        'num_shards': args.count_shards,
+        'num_docs': num_docs,
+        'tokenizer': args.tokenizer,
+        'hash_size': args.hash_size,
+        'ngram': args.ngram,
+    }
+    tmp_path = os.path.splitext(path)[0] + '.tmp.npz'
+    retriever.utils.save_sparse_csr(tmp_path, count_matrix, metadata)
+    os.replace(tmp_path, path)
+
+
+def merge_count_shards(args, count_dir):
+    """Combine all count shards into the full count matrix.
+
+    Returns the count matrix, doc frequencies (sums of the partial ones, the
+    doc ranges being disjoint) and doc dict.
+    """
+    count_mats, doc_ids = [], []
+    freqs = np.zeros(args.hash_size, dtype=np.int64)
+    for shard in range(args.count_shards):
+        path = get_count_shard_path(count_dir, shard, args.count_shards)
+        if not os.path.isfile(path):
+            raise RuntimeError('Missing count shard %s' % path)
+        logger.info('Loading %s' % path)
+        count_matrix, metadata = retriever.utils.load_sparse_csr(path)
+        for key in ('tokenizer', 'hash_size', 'ngram'):
+            if metadata[key] != getattr(args, key):
+                raise RuntimeError('%s was counted with %s = %s' %
+                                   (path, key, metadata[key]))
+        count_mats.append(count_matrix)
+        freqs += metadata['doc_freqs']
+        doc_ids.extend(metadata['doc_dict'])
+    if len(doc_ids) != metadata['num_docs']:
+        raise RuntimeError('Count shards cover %d docs, expected %d' %
+                           (len(doc_ids), metadata['num_docs']))
+    count_matrix = sp.hstack(count_mats, format='csr')
+    return count_matrix, freqs, retriever.utils.DocDict.from_ids(doc_ids)
 
 
 # ------------------------------------------------------------------------------
@@ -131,21 +273,21 @@ def get_count_matrix(args, db, db_opts):
 # ------------------------------------------------------------------------------
 
 
-def get_tfidf_matrix(cnts):
+def get_tfidf_matrix(cnts, Ns=None):
     """Convert the word count matrix into tfidf one.
 
     tfidf = log(tf + 1) * log((N - Nt + 0.5) / (Nt + 0.5))
     * tf = term frequency in document
     * N = number of documents
     * Nt = number of occurences of term in all documents
+
+    Ns (the Nt's) are computed from the counts if not given. Zero idf
+    buckets keep log(tf + 1) (see utils.get_weight_idfs).
     """
-    Ns = get_doc_freqs(cnts)
-    idfs = np.log((cnts.shape[1] - Ns + 0.5) / (Ns + 0.5))
-    idfs[idfs < 0] = 0
-    idfs = sp.diags(idfs, 0)
-    tfs = cnts.log1p()
-    tfidfs = idfs.dot(tfs)
-    return tfidfs
+    if Ns is None:
+        Ns = get_doc_freqs(cnts)
+    idfs = retriever.utils.get_weight_idfs(Ns, cnts.shape[1])
+    return retriever.utils.weight_counts(cnts, idfs)
 
 
 def get_doc_freqs(cnts):
@@ -155,6 +297,52 @@ def get_doc_freqs(cnts):
     return freqs
 
 
+# ------------------------------------------------------------------------------
+# Sharding and saving.
+# ------------------------------------------------------------------------------
+
+
+def get_shards(tfidf, metadata, num_shards):
+    """Split the tfidf matrix into shards of contiguous document ranges.
+
+    Every shard keeps the global doc_freqs (so idfs stay the same), and its
+    own doc_dict covering its documents only.
+    """
+    doc_ids = list(metadata['doc_dict'])
+    tfidf = tfidf.tocsc()
+    bounds = np.linspace(0, len(doc_ids), num_shards + 1).astype(int)
+    for i in range(num_shards):
+        start, end = bounds[i], bounds[i + 1]
+        shard = tfidf[:, start:end].tocsr()
+        shard.sort_indices()
+        shard_ids = doc_ids[start:end]
+        shard_meta = dict(metadata)
+        shard_meta['doc_dict'] = retriever.utils.DocDict.from_ids(shard_ids)
+        shard_meta['shard'] = i
+        shard_meta['num_shards'] = num_shards
+        yield shard, shard_meta
+
+
+def save(filename, tfidf, metadata, args):
+    """Save a tfidf matrix in the requested format (adds the extension)."""
+    if args.impact_order:
+        logger.info('Ordering postings by impact...')
+        metadata['max_weights'] = retriever.utils.get_max_weights(tfidf)
+        metadata['impact_order'] = retriever.utils.get_impact_order(tfidf)
+    if args.candidate_top_n:
+        logger.info('Building candidate index...')
+        metadata.update(retriever.utils.get_candidate_metadata(
+            tfidf, args.candidate_top_n
+        ))
+    if args.format == 'mmap':
+        filename += '.mmap'
+        logger.info('Saving to %s' % filename)
+        retriever.utils.save_sparse_csr_mmap(filename, tfidf, metadata)
+    else:
+        logger.info('Saving to %s.npz' % filename)
+        retriever.utils.save_sparse_csr(filename, tfidf, metadata)
+
+
 # ------------------------------------------------------------------------------
 # Main.
 # ------------------------------------------------------------------------------
@@ -176,30 +364,101 @@ if __name__ == '__main__':
                               "(e.g. 'corenlp')"))
     parser.add_argument('--num-workers', type=int, default=None,
                         help='Number of CPU processes (for tokenizing, etc)')
+    parser.add_argument('--max-memory', type=int, default=4096,
+                        help=('Memory budget (MB) for buffering counts before '
+                              'spilling them to disk'))
+    parser.add_argument('--tmp-dir', type=str, default=None,
+                        help='Directory for spilled count chunks')
+    parser.add_argument('--format', type=str, default='npz',
+                        choices=['npz', 'mmap'],
+                        help=("Save as a single .npz file or as a directory "
+                              "of raw arrays that can be memory-mapped"))
+    parser.add_argument('--impact-order', action='store_true',
+                        help=('Also store per-bucket max weights and '
+                              'impact-ordered postings (for the maxscore '
+                              'ranker)'))
+    parser.add_argument('--candidate-top-n', type=int, default=None,
+                        help=('Also store a candidate index of the top N '
+                              'postings per bucket (for the twostage ranker)'))
+    parser.add_argument('--dtype', type=str, default='float64',
+                        choices=['float64', 'float32', 'uint8'],
+                        help=('Precision of the stored weights (uint8: 8-bit '
+                              'quantized with a per-bucket scale)'))
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help=('Split the model into N shards of disjoint '
+                              'document ranges (for the sharded ranker)'))
+    parser.add_argument('--count-shards', type=int, default=None,
+                        help=('Count words in N independent jobs over '
+                              'contiguous doc ranges, saved to --count-dir '
+                              'and merged at the end (jobs already done are '
+                              'skipped, so a failed build can be resumed)'))
+    parser.add_argument('--count-shard', type=int, default=None,
+                        help=('Only run this count job (0..N-1) and exit, '
+                              'e.g. to run jobs in parallel or on other '
+                              'machines'))
+    parser.add_argument('--merge', action='store_true',
+                        help=('Do not count: merge the existing count shards '
+                              'and build the model'))
+    parser.add_argument('--count-dir', type=str, default=None,
+                        help=('Directory for count shards (default: '
+                              '<out_dir>/<model name>-counts)'))
     args = parser.parse_args()
 
-    logging.info('Counting words...')
-    count_matrix, doc_dict = get_count_matrix(
-        args, 'sqlite', {'db_path': args.db_path}
-    )
-
-    logger.info('Making tfidf vectors...')
-    tfidf = get_tfidf_matrix(count_matrix)
-
-    logger.info('Getting word-doc frequencies...')
-    freqs = get_doc_freqs(count_matrix)
-
     basename = os.path.splitext(os.path.basename(args.db_path))[0]
     basename += ('-tfidf-ngram=%d-hash=%d-tokenizer=%s' %
                  (args.ngram, args.hash_size, args.tokenizer))
     filename = os.path.join(args.out_dir, basename)
 
-    logger.info('Saving to %s.npz' % filename)
+    db_opts = {'db_path': args.db_path}
+    if args.count_shards:
+        count_dir = args.count_dir or filename + '-counts'
+        os.makedirs(count_dir, exist_ok=True)
+        if not args.merge:
+            shards = (range(args.count_shards) if args.count_shard is None
+                      else [args.count_shard])
+            for shard in shards:
+                path = get_count_shard_path(count_dir, shard,
+                                            args.count_shards)
+                if os.path.isfile(path):
+                    logger.info('Shard %d already counted (%s)' %
+                                (shard, path))
+                    continue
+                count_shard(args, 'sqlite', db_opts, shard, path)
+            if args.count_shard is not None:
+                sys.exit(0)
+
+        logger.info('Merging count shards...')
+        count_matrix, freqs, doc_dict = merge_count_shards(args, count_dir)
+    else:
+        logging.info('Counting words...')
+        count_matrix, doc_dict = get_count_matrix(args, 'sqlite', db_opts)
+
+        logger.info('Getting word-doc frequencies...')
+        freqs = get_doc_freqs(count_matrix)
+
+    logger.info('Making tfidf vectors...')
+    tfidf = get_tfidf_matrix(count_matrix, freqs)
+    tfidf.sort_indices()
+
     metadata = {
         'doc_freqs': freqs,
         'tokenizer': args.tokenizer,
         'hash_size': args.hash_size,
         'ngram': args.ngram,
-        'doc_dict': doc_dict
+        'doc_dict': doc_dict,
+        'zero_idf_tf': True,
     }
-    retriever.utils.save_sparse_csr(filename, tfidf, metadata)
+    if args.dtype != 'float64':
+        logger.info('Converting weights to %s...' % args.dtype)
+        tfidf, scales = retriever.utils.quantize(tfidf, args.dtype)
+        if scales is not None:
+            metadata['scales'] = scales
+    if args.num_shards > 1:
+        logger.info('Splitting into %d shards...' % args.num_shards)
+        for shard, shard_meta in get_shards(tfidf, metadata, args.num_shards):
+            shard_name = '%s-shard=%d-of-%d' % (
+                filename, shard_meta['shard'], args.num_shards
+            )
+            save(shard_name, shard, shard_meta, args)
+    else:
+        save(filename, tfidf, metadata, args)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""A script to merge a delta segment into its base tf-idf model.
+
+Runs offline next to a serving ranker: the compacted model is written to a
+new path, which the ranker can then be pointed at (without the delta).
+"""
+
+import numpy as np
+import scipy.sparse as sp
+import argparse
+import os
+import logging
+
+from drqa import retriever
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+def compact(base_mat, base_meta, counts, delta_meta):
+    """Reweight the live base docs with the updated idfs and append the
+    weighted delta docs. Returns the new matrix and metadata.
+
+    Quantized bases are dequantized first, and the result is stored with
+    the base precision. Impact order and candidate index are rebuilt if the
+    base has them. Older bases, with zero weights in zero idf buckets, are
+    rejected if the delta makes these idfs positive.
+    """
+    if base_meta.get('num_shards', 1) > 1:
+        raise RuntimeError('Can not compact a shard of a sharded model')
+    scales = base_meta.get('scales')
+    dtype = base_mat.dtype.name
+    if dtype not in ('float64', 'float32', 'uint8') or \
+            (dtype == 'uint8') != (scales is not None):
+        raise RuntimeError('Can not compact a model of %s weights%s' %
+                           (dtype, ' with scales' if scales is not None
+                            else ''))
+
+    base_ids = list(base_meta['doc_dict'])
+    doc_freqs = delta_meta['doc_freqs']
+    idfs = retriever.utils.get_weight_idfs(doc_freqs, delta_meta['num_docs'])
+
+    # Base weights are log(tf + 1) * base_idf: rescale them row by row
+    # (after dequantizing them).
+    logger.info('Reweighting base docs...')
+    scale = retriever.utils.get_reweighting(
+        base_meta['doc_freqs'].squeeze(), len(base_ids), idfs,
+        base_meta.get('zero_idf_tf', False)
+    )
+    if scales is not None:
+        scale *= scales
+    rows = np.repeat(np.arange(base_mat.shape[0]), np.diff(base_mat.indptr))
+    base_mat = sp.csr_matrix(
+        (base_mat.data * scale[rows], base_mat.indices, base_mat.indptr),
+        shape=base_mat.shape
+    )
+
+    logger.info('Dropping %d tombstoned docs...' %
+                len(delta_meta['tombstones']))
+    alive = np.ones(len(base_ids), dtype=bool)
+    alive[delta_meta['tombstones']] = False
+    base_mat = base_mat.tocsc()[:, np.flatnonzero(alive)]
+
+    logger.info('Appending %d delta docs...' % counts.shape[1])
+    delta_mat = retriever.utils.weight_counts(counts, idfs)
+    # Zero idf buckets keep their tfs: they record which docs have the
+    # bucket (for the doc_freqs of later deltas), and can be reweighted.
+    tfidf = sp.hstack([base_mat, delta_mat], format='csr')
+    tfidf.sort_indices()
+
+    doc_ids = [doc_id for doc_id, a in zip(base_ids, alive) if a]
+    doc_ids.extend(delta_meta['doc_ids'])
+    metadata = {
+        'doc_freqs': doc_freqs,
+        'tokenizer': base_meta['tokenizer'],
+        'hash_size': base_meta['hash_size'],
+        'ngram': base_meta['ngram'],
+        'doc_dict': retriever.utils.DocDict.from_ids(doc_ids),
+        'zero_idf_tf': True,
+    }
+    if dtype != 'float64':
+        logger.info('Converting weights to %s...' % dtype)
+        tfidf, scales = retriever.utils.quantize(tfidf, dtype)
+        if scales is not None:
+            metadata['scales'] = scales
+    if 'impact_order' in base_meta:
+        logger.info('Ordering postings by impact...')
+        metadata['max_weights'] = retriever.utils.get_max_weights(tfidf)
+        metadata['impact_order'] = retriever.utils.get_impact_order(tfidf)
+    if 'candidate_top_n' in base_meta:
+        logger.info('Building candidate index...')
+        metadata.update(retriever.utils.get_candidate_metadata(
+            tfidf, base_meta['candidate_top_n']
+        ))
+    return tfidf, metadata
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tfidf_path', type=str,
+                        help='Path to the base tf-idf model')
+    parser.add_argument('delta_path', type=str,
+                        help='Path to the delta segment (from update_tfidf.py)')
+    parser.add_argument('out_path', type=str,
+                        help=('Path of the compacted model (a .npz file, or '
+                              'a directory for the mmap format)'))
+    args = parser.parse_args()
+
+    if os.path.exists(args.out_path):
+        raise RuntimeError('%s already exists! Not overwriting.' %
+                           args.out_path)
+
+    logger.info('Loading %s' % args.tfidf_path)
+    base_mat, base_meta = retriever.utils.load_sparse_csr(args.tfidf_path)
+    logger.info('Loading %s' % args.delta_path)
+    counts, delta_meta = retriever.utils.load_sparse_csr(args.delta_path)
+    if delta_meta['base_num_docs'] != len(base_meta['doc_dict']):
+        raise RuntimeError('Delta %s was not built for this model'
+                           % args.delta_path)
+
+    tfidf, metadata = compact(base_mat, base_meta, counts, delta_meta)
+
+    logger.info('Saving to %s' % args.out_path)
+    if args.out_path.endswith('.npz'):
+        retriever.utils.save_sparse_csr(args.out_path, tfidf, metadata)
+    else:
+        retriever.utils.save_sparse_csr_mmap(args.out_path, tfidf, metadata)
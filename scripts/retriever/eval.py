@@ -6,15 +6,16 @@
 # LICENSE file in the root directory of this source tree.
 """Evaluate the accuracy of the DrQA retriever module."""
 
-import regex as re
 import logging
 import argparse
+import inspect
 import json
 import time
 import os
+import multiprocessing
+import prettytable
 
 from multiprocessing import Pool as ProcessPool
-from multiprocessing.util import Finalize
 from functools import partial
 from drqa import retriever, tokenizers
 from drqa.retriever import utils
@@ -23,64 +24,38 @@ from drqa.retriever import utils
 # Multiprocessing target functions.
 # ------------------------------------------------------------------------------
 
-PROCESS_TOK = None
-PROCESS_DB = None
 
+def get_ranker_opts(name, args):
+    """Options pointing a ranker class at the model (or doc db)."""
+    if name == 'fts5':
+        return {'db_path': args.doc_db}
+    if name == 'sharded':
+        return {'tfidf_paths': args.model}
+    return {'tfidf_path': args.model}
 
-def init(tokenizer_class, tokenizer_opts, db_class, db_opts):
-    global PROCESS_TOK, PROCESS_DB
-    PROCESS_TOK = tokenizer_class(**tokenizer_opts)
-    Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
-    PROCESS_DB = db_class(**db_opts)
-    Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
 
-
-def regex_match(text, pattern):
-    """Test if a regex pattern is contained within a text."""
-    try:
-        pattern = re.compile(
-            pattern,
-            flags=re.IGNORECASE + re.UNICODE + re.MULTILINE,
-        )
-    except BaseException:
-        return False
-    return pattern.search(text) is not None
-
-
-def has_answer(answer, doc_id, match):
-    """Check if a document contains an answer string.
-
-    If `match` is string, token matching is done between the text and answer.
-    If `match` is regex, we search the whole text with the regex.
+def rank_in_process(name, ranker_opts, questions, k, num_workers):
+    """Load a ranker and rank all questions. Meant to run in a fresh
+    process. The RSS added by the ranker is measured from the current RSS
+    before loading it: ru_maxrss can not be used, as it is inherited
+    through fork and exec from the parent (and its own ranker).
     """
-    global PROCESS_DB, PROCESS_TOK
-    text = PROCESS_DB.get_doc_text(doc_id)
-    text = utils.normalize(text)
-    if match == 'string':
-        # Answer is a list of possible strings
-        text = PROCESS_TOK.tokenize(text).words(uncased=True)
-        for single_answer in answer:
-            single_answer = utils.normalize(single_answer)
-            single_answer = PROCESS_TOK.tokenize(single_answer)
-            single_answer = single_answer.words(uncased=True)
-            for i in range(0, len(text) - len(single_answer) + 1):
-                if single_answer == text[i: i + len(single_answer)]:
-                    return True
-    elif match == 'regex':
-        # Answer is a regex
-        single_answer = utils.normalize(answer[0])
-        if regex_match(text, single_answer):
-            return True
-    return False
-
-
-def get_score(answer_doc, match):
-    """Search through all the top docs to see if they have the answer."""
-    answer, (doc_ids, doc_scores) = answer_doc
-    for doc_id in doc_ids:
-        if has_answer(answer, doc_id, match):
-            return 1
-    return 0
+    base_rss = utils.rss_mb()
+    has_peak = utils.reset_peak_rss()
+    t0 = time.time()
+    ranker = retriever.get_class(name)(**ranker_opts)
+    load_time = time.time() - t0
+    load_rss = utils.rss_mb()
+    t0 = time.time()
+    closest_docs = ranker.batch_closest_docs(questions, k=k,
+                                             num_workers=num_workers)
+    rank_time = time.time() - t0
+    if base_rss is None:
+        return closest_docs, load_time, rank_time, None
+    # Without a resettable peak, the highest of the sampled current RSS.
+    peak_rss = (utils.rss_mb('VmHWM') if has_peak else
+                max(load_rss, utils.rss_mb()))
+    return closest_docs, load_time, rank_time, peak_rss - base_rss
 
 
 # ------------------------------------------------------------------------------
@@ -100,6 +75,24 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('dataset', type=str, default=None)
     parser.add_argument('--model', type=str, default=None)
+    parser.add_argument('--ranker', type=str, default='tfidf',
+                        help=("Ranker class to use (e.g. 'tfidf', 'maxscore', "
+                              "'twostage')"))
+    parser.add_argument('--check', action='store_true',
+                        help=('Compare rankings with exhaustive scoring and '
+                              'report differences (maxscore, twostage)'))
+    parser.add_argument('--ref-model', type=str, default=None,
+                        help=('Also evaluate this reference model (e.g. the '
+                              'float64 one) and report the difference'))
+    parser.add_argument('--max-terms', type=int, default=None,
+                        help=('Query-term pruning: keep the N highest-idf '
+                              'terms (reports the cost vs. no pruning)'))
+    parser.add_argument('--weight-frac', type=float, default=None,
+                        help=('Query-term pruning: keep the terms covering '
+                              'this fraction of the query weight'))
+    parser.add_argument('--compare', type=str, nargs='+', default=[],
+                        help=('Also compare these ranker classes (e.g. '
+                              "'tfidf', 'fts5'): memory, latency and recall"))
     parser.add_argument('--doc-db', type=str, default=None,
                         help='Path to Document DB')
     parser.add_argument('--tokenizer', type=str, default='regexp')
@@ -109,6 +102,17 @@ if __name__ == '__main__':
                         choices=['regex', 'string'])
     args = parser.parse_args()
 
+    # Options only some ranker classes take.
+    ranker_params = inspect.signature(
+        retriever.get_class(args.ranker)
+    ).parameters
+    if args.check and 'check' not in ranker_params:
+        parser.error('the %s ranker has no --check' % args.ranker)
+    if (args.max_terms is not None or args.weight_frac is not None) and \
+            'max_terms' not in ranker_params:
+        parser.error('the %s ranker has no query-term budget (--max-terms, '
+                     '--weight-frac)' % args.ranker)
+
     # start time
     start = time.time()
 
@@ -125,12 +129,27 @@ if __name__ == '__main__':
 
     # get the closest docs for each question.
     logger.info('Initializing ranker...')
-    ranker = retriever.get_class('tfidf')(tfidf_path=args.model)
+    ranker_opts = get_ranker_opts(args.ranker, args)
+    if args.check:
+        ranker_opts['check'] = True
+    pruning = args.max_terms is not None or args.weight_frac is not None
+    if pruning:
+        ranker_opts['max_terms'] = args.max_terms
+        ranker_opts['weight_frac'] = args.weight_frac
+    ranker = retriever.get_class(args.ranker)(**ranker_opts)
 
     logger.info('Ranking...')
     closest_docs = ranker.batch_closest_docs(
         questions, k=args.n_docs, num_workers=args.num_workers
     )
+    if hasattr(ranker, 'stats'):
+        logger.info('Read %d/%d postings (%2.2f%%), %d ranking differences' %
+                    (ranker.stats['read'], ranker.stats['total'],
+                     100 * ranker.stats['read'] / max(ranker.stats['total'], 1),
+                     ranker.stats['diffs']))
+    if hasattr(ranker, 'stats') and 'unsafe' in ranker.stats:
+        logger.info('%d/%d rankings not proven exact' %
+                    (ranker.stats['unsafe'], ranker.stats['queries']))
     answers_docs = zip(answers, closest_docs)
 
     # define processes
@@ -140,13 +159,13 @@ if __name__ == '__main__':
     db_opts = {'db_path': args.doc_db}
     processes = ProcessPool(
         processes=args.num_workers,
-        initializer=init,
+        initializer=utils.init_answer_match,
         initargs=(tok_class, tok_opts, db_class, db_opts)
     )
 
     # compute the scores for each pair, and print the statistics
     logger.info('Retrieving and computing scores...')
-    get_score_partial = partial(get_score, match=args.match)
+    get_score_partial = partial(utils.get_answer_score, match=args.match)
     scores = processes.map(get_score_partial, answers_docs)
 
     filename = os.path.basename(args.dataset)
@@ -166,4 +185,70 @@ if __name__ == '__main__':
         t=time.time() - start,
     )
 
+    # Compare with the reference model (or the same ranker without query-term
+    # pruning): answer recall and top k overlap.
+    ref_closest_docs = None
+    if args.ref_model:
+        logger.info('Ranking with reference model...')
+        ref_ranker = retriever.get_class('tfidf')(tfidf_path=args.ref_model)
+        ref_closest_docs = ref_ranker.batch_closest_docs(
+            questions, k=args.n_docs, num_workers=args.num_workers
+        )
+    elif pruning:
+        logger.info('Ranking without query-term pruning...')
+        ref_closest_docs = ranker.batch_closest_docs(
+            questions, k=args.n_docs, num_workers=args.num_workers,
+            max_terms=0, weight_frac=1
+        )
+    if ref_closest_docs is not None:
+        ref_scores = processes.map(get_score_partial,
+                                   zip(answers, ref_closest_docs))
+        overlaps = [len(set(docs[0]) & set(ref_docs[0])) /
+                    max(len(ref_docs[0]), 1)
+                    for docs, ref_docs in zip(closest_docs, ref_closest_docs)]
+        ref_p = sum(ref_scores) / len(ref_scores) * 100
+        stats += (
+            "Ref. match % in top {k}:\t\t{rp:2.2f}\n" +
+            "Match % change:\t\t\t{dp:+2.2f}\n" +
+            "Top {k} overlap with ref. %:\t{o:2.2f}\n"
+        ).format(
+            k=args.n_docs,
+            rp=ref_p,
+            dp=(sum(scores) / len(scores) * 100) - ref_p,
+            o=(sum(overlaps) / len(overlaps) * 100),
+        )
+
+    # Compare ranker classes, each loaded in a fresh process.
+    if args.compare:
+        table = prettytable.PrettyTable(
+            ['Ranker', 'Load (s)', 'ms/query', 'Peak RSS (+MB)',
+             'Match %% in top %d' % args.n_docs,
+             'Top %d overlap %%' % args.n_docs]
+        )
+        spawn = multiprocessing.get_context('spawn')
+        for name in args.compare:
+            logger.info('Comparing with %s ranker...' % name)
+            with spawn.Pool(1) as process:
+                cmp_closest_docs, load_time, rank_time, peak_rss = \
+                    process.apply(rank_in_process, (
+                        name, get_ranker_opts(name, args), questions,
+                        args.n_docs, args.num_workers
+                    ))
+            cmp_scores = processes.map(get_score_partial,
+                                       zip(answers, cmp_closest_docs))
+            overlaps = [len(set(docs[0]) & set(cmp_docs[0])) /
+                        max(len(docs[0]), 1)
+                        for docs, cmp_docs in zip(closest_docs,
+                                                  cmp_closest_docs)]
+            table.add_row([
+                name, '%.2f' % load_time,
+                '%.2f' % (rank_time / len(questions) * 1000),
+                'n/a' if peak_rss is None else '%.0f' % peak_rss,
+                '%.2f' % (sum(cmp_scores) / len(cmp_scores) * 100),
+                '%.2f' % (sum(overlaps) / len(overlaps) * 100),
+            ])
+        stats += '\nTop %d overlap is with the %s ranker.\n%s\n' % (
+            args.n_docs, args.ranker, table
+        )
+
     print(stats)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""A script to statically prune a tf-idf model, and report what it costs.
+
+Low-weight postings rarely make it into a top-k list. Pruning keeps only
+the top N documents per hash bucket and/or drops weights below a threshold.
+The pruned models keep the original doc_freqs, so TfidfDocRanker loads them
+unchanged. For every pruning level, the index size, query latency, top-k
+overlap with the unpruned model and (given a doc db) the eval.py answer
+match % are printed side by side.
+
+Pruned models can not take delta segments (update_tfidf.py needs every
+posting to update doc_freqs): update the unpruned model and prune again.
+"""
+
+import argparse
+import json
+import os
+import time
+import logging
+import numpy as np
+import prettytable
+
+from multiprocessing import Pool as ProcessPool
+from functools import partial
+
+from drqa import retriever, tokenizers
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+# ------------------------------------------------------------------------------
+# Utilities.
+# ------------------------------------------------------------------------------
+
+
+def get_size(path):
+    """Size on disk of a model file or directory, in bytes."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f))
+                   for f in os.listdir(path))
+    return os.path.getsize(path)
+
+
+# ------------------------------------------------------------------------------
+# Evaluation.
+# ------------------------------------------------------------------------------
+
+
+def evaluate(path, questions, answers, ref_docs, args, processes=None):
+    """Rank all questions with a model. Returns latency (ms/query), the top-k
+    overlap % with ref_docs (if given), the answer match % (if processes)
+    and the rankings.
+    """
+    ranker = retriever.get_class('tfidf')(tfidf_path=path, strict=False)
+    t0 = time.time()
+    closest_docs = [ranker.closest_docs(q, k=args.n_docs) for q in questions]
+    latency = (time.time() - t0) / len(questions) * 1000
+
+    overlap = None
+    if ref_docs:
+        overlap = np.mean([len(set(d[0]) & set(r[0])) / max(len(r[0]), 1)
+                           for d, r in zip(closest_docs, ref_docs)]) * 100
+    match = None
+    if processes:
+        get_score_partial = partial(retriever.utils.get_answer_score,
+                                    match=args.match)
+        scores = processes.map(get_score_partial, zip(answers, closest_docs))
+        match = sum(scores) / len(scores) * 100
+    return latency, overlap, match, closest_docs
+
+
+# ------------------------------------------------------------------------------
+# Main.
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tfidf_path', type=str,
+                        help='Path to the tf-idf model to prune')
+    parser.add_argument('out_dir', type=str,
+                        help='Directory for saving pruned models')
+    parser.add_argument('--top-n', type=int, nargs='*', default=[],
+                        help='Pruning levels: keep top N docs per bucket')
+    parser.add_argument('--threshold', type=float, nargs='*', default=[],
+                        help='Pruning levels: drop weights below threshold')
+    parser.add_argument('--format', type=str, default='npz',
+                        choices=['npz', 'mmap'],
+                        help='Save format of the pruned models')
+    parser.add_argument('--dataset', type=str, default=None,
+                        help='Questions to evaluate on (eval.py format)')
+    parser.add_argument('--doc-db', type=str, default=None,
+                        help='Path to Document DB (for answer match %%)')
+    parser.add_argument('--tokenizer', type=str, default='regexp')
+    parser.add_argument('--n-docs', type=int, default=5)
+    parser.add_argument('--num-workers', type=int, default=None)
+    parser.add_argument('--match', type=str, default='string',
+                        choices=['regex', 'string'])
+    args = parser.parse_args()
+
+    logger.info('Loading %s' % args.tfidf_path)
+    matrix, metadata = retriever.utils.load_sparse_csr(args.tfidf_path)
+    basename = os.path.basename(args.tfidf_path.rstrip('/'))
+    basename = os.path.splitext(basename)[0]
+
+    # Thresholds apply to the weights queries see: dequantized, and 0 in zero
+    # idf buckets (which only keep their tfs, see utils.get_weight_idfs).
+    weight_scales = np.ones(matrix.shape[0])
+    if metadata.get('scales') is not None:
+        weight_scales *= metadata['scales']
+    if metadata.get('zero_idf_tf'):
+        idfs = retriever.utils.get_idfs(metadata['doc_freqs'].squeeze(),
+                                        len(metadata['doc_dict']))
+        weight_scales[idfs == 0] = 0
+
+    # Prune at every level and save.
+    levels = [('none', args.tfidf_path, matrix.nnz)]
+    for name, opts in ([('top=%d' % n, {'top_n': n}) for n in args.top_n] +
+                       [('min=%g' % w, {'threshold': w})
+                        for w in args.threshold]):
+        logger.info('Pruning (%s)...' % name)
+        pruned = retriever.utils.prune_rows(matrix, scales=weight_scales,
+                                            **opts)
+        # Deltas need every posting to update doc_freqs (see update_tfidf).
+        pruned_meta = dict(metadata, pruned=name)
+        if 'impact_order' in metadata:
+            pruned_meta['max_weights'] = retriever.utils.get_max_weights(pruned)
+            pruned_meta['impact_order'] = retriever.utils.get_impact_order(
+                pruned
+            )
+        if 'candidate_top_n' in metadata:
+            pruned_meta.update(retriever.utils.get_candidate_metadata(
+                pruned, metadata['candidate_top_n']
+            ))
+        filename = os.path.join(args.out_dir, '%s-%s' % (basename, name))
+        if args.format == 'mmap':
+            filename += '.mmap'
+            retriever.utils.save_sparse_csr_mmap(filename, pruned, pruned_meta)
+        else:
+            retriever.utils.save_sparse_csr(filename, pruned, pruned_meta)
+            filename += '.npz'
+        logger.info('Saved to %s' % filename)
+        levels.append((name, filename, pruned.nnz))
+
+    if not args.dataset:
+        raise SystemExit
+
+    # Evaluate every level against the unpruned model.
+    questions, answers = [], []
+    for line in open(args.dataset):
+        data = json.loads(line)
+        questions.append(data['question'])
+        answers.append(data['answer'])
+
+    processes = None
+    if args.doc_db:
+        processes = ProcessPool(
+            processes=args.num_workers,
+            initializer=retriever.utils.init_answer_match,
+            initargs=(tokenizers.get_class(args.tokenizer), {},
+                      retriever.DocDB, {'db_path': args.doc_db})
+        )
+
+    table = prettytable.PrettyTable(
+        ['Pruning', 'Postings', 'Size (MB)', 'ms/query',
+         'Top %d overlap %%' % args.n_docs, 'Match %% in top %d' % args.n_docs]
+    )
+    ref_docs = None
+    for name, filename, nnz in levels:
+        logger.info('Evaluating (%s)...' % name)
+        latency, overlap, match, closest_docs = evaluate(
+            filename, questions, answers, ref_docs, args, processes
+        )
+        ref_docs = ref_docs or closest_docs
+        table.add_row([
+            name, nnz, '%.1f' % (get_size(filename) / 1024 ** 2),
+            '%.2f' % latency,
+            '%.2f' % overlap if overlap is not None else '100.00',
+            '%.2f' % match if match is not None else '-',
+        ])
+    print(table)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""A script to build (or extend) a delta segment for a tf-idf model.
+
+Documents added to the db since the model was built, or listed as changed,
+are counted into a small side index. Documents removed from the db (and the
+old versions of changed ones) are tombstoned, and doc_freqs are updated.
+The ranker scores the delta on top of the base model; compact_tfidf.py
+merges it back in.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+import argparse
+import os
+import logging
+
+from multiprocessing import Pool as ProcessPool
+from multiprocessing.util import Finalize
+from functools import partial
+
+from drqa import retriever
+from drqa import tokenizers
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+# ------------------------------------------------------------------------------
+# Multiprocessing functions
+# ------------------------------------------------------------------------------
+
+PROCESS_TOK = None
+PROCESS_DB = None
+
+
+def init(tokenizer_class, db_class, db_opts):
+    global PROCESS_TOK, PROCESS_DB
+    PROCESS_TOK = tokenizer_class()
+    Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
+    PROCESS_DB = db_class(**db_opts)
+    Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
+
+
+def fetch_text(doc_id):
+    global PROCESS_DB
+    return PROCESS_DB.get_doc_text(doc_id)
+
+
+def tokenize(text):
+    global PROCESS_TOK
+    return PROCESS_TOK.tokenize(text)
+
+
+def count(ngram, hash_size, doc_id):
+    """Fetch the text of a document and compute hashed ngrams counts."""
+    tokens = tokenize(retriever.utils.normalize(fetch_text(doc_id)))
+    row, data = retriever.utils.hash_ngrams(
+        tokens.words(uncased=True), ngram, hash_size
+    )
+    return row.tolist(), data.tolist()
+
+
+# ------------------------------------------------------------------------------
+# Delta construction.
+# ------------------------------------------------------------------------------
+
+
+def get_doc_presence(matrix, cols):
+    """Return word --> # of docs it appears in, among columns cols.
+
+    Every stored entry counts, zero weights included: models keep the
+    entries of zero idf buckets so that their presence is exact.
+    """
+    mask = np.zeros(matrix.shape[1], dtype=bool)
+    mask[cols] = True
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    keep = mask[matrix.indices]
+    return np.bincount(rows[keep], minlength=matrix.shape[0])
+
+
+def build_delta(args):
+    """Bring the delta of args.tfidf_path in sync with the db at args.db_path.
+    """
+    logger.info('Loading base model %s' % args.tfidf_path)
+    base_mat, base_meta = retriever.utils.load_sparse_csr(args.tfidf_path)
+    if 'pruned' in base_meta:
+        raise RuntimeError('%s is pruned (%s): its postings can not update '
+                           'doc_freqs, update the unpruned model instead' %
+                           (args.tfidf_path, base_meta['pruned']))
+    base_ids = list(base_meta['doc_dict'])
+    hash_size = base_meta['hash_size']
+
+    # Start from the current delta, if there is one.
+    if os.path.isfile(args.delta_path):
+        logger.info('Extending delta %s' % args.delta_path)
+        counts, meta = retriever.utils.load_sparse_csr(args.delta_path)
+        if meta['base_num_docs'] != len(base_ids):
+            raise RuntimeError('Delta %s was not built for this model'
+                               % args.delta_path)
+        delta_ids = list(meta['doc_ids'])
+        tombstones = set(meta['tombstones'].tolist())
+        doc_freqs = meta['doc_freqs'].copy()
+    else:
+        counts = sp.csr_matrix((hash_size, 0))
+        delta_ids = []
+        tombstones = set()
+        doc_freqs = base_meta['doc_freqs'].squeeze().copy()
+
+    with retriever.DocDB(args.db_path) as doc_db:
+        db_ids = set(doc_db.get_doc_ids())
+    changed = set()
+    if args.changed:
+        with open(args.changed) as f:
+            changed = {retriever.utils.normalize(line.strip()) for line in f
+                       if line.strip()}
+        changed &= db_ids
+
+    # Old versions of deleted and changed docs are removed.
+    drop_delta = [i for i, doc_id in enumerate(delta_ids)
+                  if doc_id not in db_ids or doc_id in changed]
+    drop_base = [i for i, doc_id in enumerate(base_ids)
+                 if (doc_id not in db_ids or doc_id in changed) and
+                 i not in tombstones]
+
+    # Deleted base docs only have their stored entries left. Models built
+    # before zero idf entries were kept lack those, so doc_freqs are clipped
+    # to [0, num_docs] below.
+    doc_freqs -= get_doc_presence(counts, drop_delta)
+    doc_freqs -= get_doc_presence(base_mat, drop_base)
+    tombstones.update(drop_base)
+    keep = np.setdiff1d(np.arange(len(delta_ids)), drop_delta)
+    counts = counts.tocsc()[:, keep].tocsr()
+    delta_ids = [delta_ids[i] for i in keep]
+
+    # Whatever is in the db but not live in the base or delta gets added.
+    live_ids = {doc_id for i, doc_id in enumerate(base_ids)
+                if i not in tombstones}
+    live_ids.update(delta_ids)
+    added = sorted(db_ids - live_ids)
+    logger.info('Adding %d docs, removing %d docs' %
+                (len(added), len(drop_delta) + len(drop_base)))
+
+    # Count the added docs.
+    tok_class = tokenizers.get_class(base_meta['tokenizer'])
+    workers = ProcessPool(
+        args.num_workers,
+        initializer=init,
+        initargs=(tok_class, retriever.DocDB, {'db_path': args.db_path})
+    )
+    _count = partial(count, base_meta['ngram'], hash_size)
+    row, col, data = [], [], []
+    for i, (b_row, b_data) in enumerate(workers.imap(_count, added)):
+        row.extend(b_row)
+        col.extend([i] * len(b_row))
+        data.extend(b_data)
+    workers.close()
+    workers.join()
+    added_counts = sp.csr_matrix(
+        (data, (row, col)), shape=(hash_size, len(added))
+    )
+    doc_freqs += get_doc_presence(added_counts, np.arange(len(added)))
+
+    counts = sp.hstack([counts, added_counts], format='csr')
+    counts.sum_duplicates()
+    delta_ids.extend(added)
+    num_docs = len(base_ids) - len(tombstones) + len(delta_ids)
+    doc_freqs = np.clip(doc_freqs, 0, num_docs)
+
+    # Write next to the old delta and swap, so rankers never see a partial one.
+    logger.info('Saving to %s (%d docs, %d tombstones)' %
+                (args.delta_path, len(delta_ids), len(tombstones)))
+    metadata = {
+        'doc_ids': retriever.utils.DocDict.from_ids(delta_ids),
+        'tombstones': np.array(sorted(tombstones), dtype=np.int64),
+        'doc_freqs': doc_freqs,
+        'num_docs': num_docs,
+        'base_num_docs': len(base_ids),
+    }
+    tmp_path = args.delta_path + '.tmp.npz'
+    retriever.utils.save_sparse_csr(tmp_path, counts, metadata)
+    os.replace(tmp_path, args.delta_path)
+
+
+# ------------------------------------------------------------------------------
+# Main.
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_path', type=str,
+                        help='Path to sqlite db holding document texts')
+    parser.add_argument('tfidf_path', type=str,
+                        help='Path to the base tf-idf model')
+    parser.add_argument('delta_path', type=str,
+                        help='Path to the delta .npz to create or extend')
+    parser.add_argument('--changed', type=str, default=None,
+                        help=('File with the ids of edited documents, one per '
+                              'line (added and deleted docs are detected)'))
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='Number of CPU processes (for tokenizing, etc)')
+    args = parser.parse_args()
+    if not args.delta_path.endswith('.npz'):
+        raise RuntimeError('Delta path must end with .npz')
+    build_delta(args)
@@ -26,4 +26,8 @@ setup(
     python_requires='>=3.5',
     packages=find_packages(exclude=('data')),
     install_requires=reqs.strip().split('\n'),
+    extras_require={
+        # zstd compressed document dbs (build_db.py --compress zstd)
+        'zstd': ['zstandard'],
+    },
 )